@@ -1,13 +1,14 @@
 import streamlit as st
 import pandas as pd
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from twilio.rest import Client
 import os
+import tempfile
 from datetime import datetime, timedelta
-import json
-import time
+import smtp_pool
+import sms_client
+from repository import CONTACT_FIELDS, ContactIndex
+from contact_import import import_contacts
 
 # Configure Streamlit page
 st.set_page_config(
@@ -17,20 +18,45 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+@st.cache_resource
+def load_roster():
+    """Load contacts.csv once per process; every session shares the same immutable roster"""
+    return ContactIndex(import_contacts('contacts.csv').contacts if os.path.exists('contacts.csv') else [])
+
+def save_roster(contacts):
+    """Write an imported roster to contacts.csv and make it the roster every session reads"""
+    # Write a temporary file and rename it into place, so a crash never leaves a truncated roster
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.csv', dir='.')
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            pd.DataFrame([dict(c) for c in contacts], columns=CONTACT_FIELDS).to_csv(f, index=False)
+        os.replace(tmp_path, 'contacts.csv')
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    load_roster.clear()
+    return load_roster()
+
 # Initialize session state
 if 'canceled_lessons' not in st.session_state:
     st.session_state.canceled_lessons = []
-if 'contacts_db' not in st.session_state:
-    st.session_state.contacts_db = pd.read_csv('contacts.csv').to_json(orient='records')#[]
+# Sessions only hold a reference to the shared roster, so an upload reaches every session
+st.session_state.contacts_db = load_roster()
 if 'notification_log' not in st.session_state:
     st.session_state.notification_log = []
+if 'last_lesson_id' not in st.session_state:
+    # Only ever increases, so ids are not reused after lessons are removed
+    st.session_state.last_lesson_id = 0
 
 # Configuration - In production, use st.secrets
 EMAIL_CONFIG = {
     'smtp_server': st.secrets.get('smtp_server', 'smtp.gmail.com'),
     'smtp_port': st.secrets.get('smtp_port', 587),
     'email': st.secrets.get('email_address', ''),
-    'password': st.secrets.get('email_password', '')
+    'password': st.secrets.get('email_password', ''),
+    'pool_size': st.secrets.get('smtp_pool_size', 4),
+    'idle_timeout': st.secrets.get('smtp_idle_timeout', 60)
 }
 
 TWILIO_CONFIG = {
@@ -97,11 +123,16 @@ def send_email(to_email, subject, body):
 
         msg.attach(MIMEText(body, 'plain'))
 
-        server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-        server.starttls()
-        server.login(EMAIL_CONFIG['email'], EMAIL_CONFIG['password'])
-        server.send_message(msg)
-        server.quit()
+        # Reuse a logged-in connection from the shared pool
+        pool = smtp_pool.get_pool(
+            EMAIL_CONFIG['smtp_server'],
+            EMAIL_CONFIG['smtp_port'],
+            EMAIL_CONFIG['email'],
+            EMAIL_CONFIG['password'],
+            max_size=EMAIL_CONFIG['pool_size'],
+            idle_timeout=EMAIL_CONFIG['idle_timeout']
+        )
+        pool.send_message(msg)
 
         return True, "Email sent successfully"
     except Exception as e:
@@ -113,16 +144,13 @@ def send_sms(to_phone, message):
     if not TWILIO_CONFIG['account_sid'] or not TWILIO_CONFIG['auth_token']:
         return False, "SMS configuration not set"
 
-    try:
-        client = Client(TWILIO_CONFIG['account_sid'], TWILIO_CONFIG['auth_token'])
-        message = client.messages.create(
-            body=message,
-            from_=TWILIO_CONFIG['phone_number'],
-            to=to_phone
-        )
-        return True, "SMS sent successfully"
-    except Exception as e:
-        return False, f"SMS error: {str(e)}"
+    # Reuse the shared client and its keep-alive connections
+    client = sms_client.get_client(
+        TWILIO_CONFIG['account_sid'],
+        TWILIO_CONFIG['auth_token'],
+        TWILIO_CONFIG['phone_number']
+    )
+    return client.send(to_phone, message)
 
 
 def log_notification(message):
@@ -234,6 +262,14 @@ Your Fencing Coach
     return results
 
 
+@st.fragment(run_every=30)
+def auto_refresh():
+    """Rerun the app every 30 seconds without blocking the script thread"""
+    if st.session_state.get('auto_refresh_armed'):
+        st.rerun(scope="app")
+    st.session_state.auto_refresh_armed = True
+
+
 def main():
     # Header
     st.title("🤺 Fencing Lesson Manager")
@@ -247,18 +283,42 @@ def main():
         st.subheader("Upload Contacts")
         uploaded_file = st.file_uploader("Choose CSV file", type="csv")
 
-        if uploaded_file is not None:
+        if uploaded_file is not None and st.session_state.get('contacts_upload_id') != uploaded_file.file_id:
+            # Import each uploaded file once, not on every rerun while it stays in the uploader
+            st.session_state.contacts_upload_id = uploaded_file.file_id
             try:
-                df = pd.read_csv(uploaded_file)
-                st.session_state.contacts_db = df.to_dict('records')
-                st.success(f"✅ Loaded {len(st.session_state.contacts_db)} contacts")
+                result = import_contacts(uploaded_file)
+                # A file where every row was rejected must not wipe out the saved roster
+                if result.contacts:
+                    st.session_state.contacts_db = save_roster(result.contacts)
+                st.session_state.contacts_import = {
+                    'saved': len(result.contacts),
+                    'summary': result.summary(),
+                    'issues': result.issues,
+                    'issue_count': result.issue_count,
+                    'preview': [dict(c) for c in result.contacts[:5]]
+                }
+            except Exception as e:
+                st.session_state.contacts_import = f"Error loading CSV: {str(e)}"
 
-                # Show sample of contacts
-                st.subheader("Contacts Preview")
-                st.dataframe(df.head(), use_container_width=True)
+        if uploaded_file is not None and 'contacts_import' in st.session_state:
+            report = st.session_state.contacts_import
+            if isinstance(report, str):
+                st.error(report)
+            else:
+                if report['saved']:
+                    st.success(f"✅ Loaded {len(st.session_state.contacts_db)} contacts")
+                else:
+                    st.error("No row in this file passed validation, so the existing contacts were kept.")
+                st.caption(report['summary'])
+                if report['issues']:
+                    with st.expander(f"⚠️ {report['issue_count']} rows need attention"):
+                        st.dataframe(pd.DataFrame(report['issues']), use_container_width=True)
 
-            except Exception as e:
-                st.error(f"Error loading CSV: {str(e)}")
+                if report['preview']:
+                    # Show sample of contacts
+                    st.subheader("Contacts Preview")
+                    st.dataframe(pd.DataFrame(report['preview']), use_container_width=True)
 
         # Configuration status
         st.subheader("System Status")
@@ -332,8 +392,9 @@ def main():
         if submitted:
             if lesson_date and lesson_time and original_student:
                 # Create cancellation record
+                st.session_state.last_lesson_id += 1
                 cancellation = {
-                    'id': len(st.session_state.canceled_lessons) + 1,
+                    'id': st.session_state.last_lesson_id,
                     'date': lesson_date,
                     'time': lesson_time,
                     'original_student': original_student,
@@ -381,11 +442,8 @@ def main():
                     )
 
                     if st.button(f"✅ Fill Slot with {selected_contact_name}", key=f"fill_{lesson['id']}"):
-                        # Find the selected contact
-                        selected_contact = next(
-                            (c for c in st.session_state.contacts_db if c.get('name') == selected_contact_name),
-                            None
-                        )
+                        # Find the selected contact by name in the index
+                        selected_contact = st.session_state.contacts_db.find_by_name(selected_contact_name)
 
                         if selected_contact:
                             # Update lesson status
@@ -432,11 +490,12 @@ def main():
 
     # Auto-refresh option
     st.sidebar.header("🔄 Auto-refresh")
-    auto_refresh = st.sidebar.checkbox("Enable auto-refresh (30 seconds)")
+    auto_refresh_enabled = st.sidebar.checkbox("Enable auto-refresh (30 seconds)")
 
-    if auto_refresh:
-        time.sleep(30)
-        st.rerun()
+    if auto_refresh_enabled:
+        # A full run disarms the timer so the next tick, not this one, reruns the app
+        st.session_state.auto_refresh_armed = False
+        auto_refresh()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,399 @@
+"""Headless benchmarks for the cancellation-to-fill pipeline.
+
+Drives the same helpers the Streamlit pages use (loading and saving the
+lesson log, sidebar statistics, announcing a slot, the Fill page claim and the
+"lesson filled" notices) against synthetic data, a local fake SMTP server
+and the fake SMS transport, so nothing leaves the machine.
+
+For each scenario it reports throughput, p50/p99 latency and peak traced
+memory, and writes the results as JSON so runs can be compared:
+
+    python benchmark.py --contacts 1000 --lessons 10000 --output bench.json
+    python benchmark.py --output new.json --baseline bench.json
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import storage
+
+COACHES = ['Julian', 'Frederick', 'Anna', 'Marco', 'Elena']
+SMTP_USER = 'bench@example.com'
+CLAIM_SECRET = 'benchmark-secret'
+
+
+# --- Synthetic data ---
+def make_contacts(count, seed=0):
+    """Return ``count`` synthetic members with an email address and a phone number"""
+    rng = random.Random(seed)
+    return [
+        {'contact_id': i, 'name': f"Member {i}", 'email': f"member{i}@example.com",
+         'phone': f"+1617{rng.randrange(10 ** 7):07d}"}
+        for i in range(1, count + 1)
+    ]
+
+
+def make_lessons(count, seed=0, filled_ratio=0.8):
+    """Return ``count`` synthetic lessons spread over the last and next two months"""
+    rng = random.Random(seed)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    lessons = []
+    for i in range(1, count + 1):
+        lesson_date = today + timedelta(days=rng.randint(-60, 60))
+        created_at = lesson_date - timedelta(days=rng.randint(1, 7), minutes=rng.randint(0, 600))
+        lesson = {
+            'id': i,
+            'date': lesson_date.strftime('%Y-%m-%d'),
+            'time': f"{rng.randint(9, 19):02d}:{rng.choice(['00', '30'])}",
+            'coach': rng.choice(COACHES),
+            'original_student': f"Student {rng.randint(1, 500)}",
+            'status': 'available',
+            'created_at': created_at.strftime('%Y-%m-%d %H:%M'),
+            'filled_by': '',
+            'filled_at': ''
+        }
+        if rng.random() < filled_ratio:
+            lesson['status'] = 'filled'
+            lesson['filled_by'] = f"Member {rng.randint(1, 1000)}"
+            lesson['filled_at'] = (created_at + timedelta(hours=rng.randint(1, 48))).strftime('%Y-%m-%d %H:%M')
+        lessons.append(lesson)
+    return lessons
+
+
+# --- Fake SMTP server ---
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP, QUIT"""
+
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self._reply("220 localhost fake SMTP ready")
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b"250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 10485760\r\n")
+            elif command == b'AUTH':
+                self._reply("235 Authentication successful")
+            elif command == b'RCPT':
+                recipients += 1
+                self._reply("250 OK")
+            elif command == b'DATA':
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                if server.latency:
+                    time.sleep(server.latency)
+                server.record(recipients)
+                recipients = 0
+                self._reply("250 OK queued")
+            elif command == b'RSET':
+                recipients = 0
+                self._reply("250 OK")
+            elif command == b'QUIT':
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Threaded local SMTP server that accepts and counts messages"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.latency = latency
+        self.messages = 0
+        self.recipients = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, recipients):
+        with self._lock:
+            self.messages += 1
+            self.recipients += recipients
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-smtp", daemon=True).start()
+        return self
+
+
+# --- Measurement ---
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def measure(run, repeat, items=1):
+    """Time ``run(i)`` for ``repeat`` iterations after one traced warm-up call.
+
+    The warm-up runs under tracemalloc to record peak memory, so tracing
+    overhead does not distort the timed iterations. With fewer than one
+    iteration, e.g. when a contention run won too few claims to replay,
+    nothing runs and the timings are None.
+    """
+    if repeat < 1:
+        return {'iterations': 0, 'items_per_iteration': items, 'throughput_per_s': None, 'mean_ms': None,
+                'p50_ms': None, 'p99_ms': None, 'peak_memory_kb': None}
+    tracemalloc.start()
+    run(0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = []
+    for i in range(1, repeat + 1):
+        start = time.perf_counter()
+        run(i)
+        latencies.append(time.perf_counter() - start)
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'iterations': repeat,
+        'items_per_iteration': items,
+        'throughput_per_s': round(items * repeat / total, 2) if total else None,
+        'mean_ms': round(total / repeat * 1000, 3),
+        'p50_ms': round(_percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3),
+        'peak_memory_kb': round(peak / 1024, 1)
+    }
+
+
+# --- Multi-process scenarios (storage only, so workers start quickly) ---
+def _open_store(backend, lessons_csv, contacts_csv, sqlite_path):
+    if backend == 'sqlite':
+        return storage.SQLiteStore(sqlite_path)
+    return storage.CSVStore(lessons_csv, contacts_csv)
+
+
+def _claim_worker(args):
+    backend, lessons_csv, contacts_csv, sqlite_path, lesson_ids, worker = args
+    store = _open_store(backend, lessons_csv, contacts_csv, sqlite_path)
+    lesson_ids = list(lesson_ids)
+    random.Random(worker).shuffle(lesson_ids)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M')
+    return [lesson_id for lesson_id in lesson_ids if store.claim_lesson(lesson_id, f"Worker {worker}", now)]
+
+
+def _add_worker(args):
+    backend, lessons_csv, contacts_csv, sqlite_path, count, worker = args
+    store = _open_store(backend, lessons_csv, contacts_csv, sqlite_path)
+    template = make_lessons(1, seed=worker)[0]
+    return [store.add_lesson(dict(template, id=None, status='available')) for _ in range(count)]
+
+
+def run_contention(backend, workdir, workers, lessons):
+    """Have ``workers`` processes race to claim the same lessons and add new ones at once"""
+    lessons_csv = os.path.join(workdir, 'contention.csv')
+    contacts_csv = os.path.join(workdir, 'contention_contacts.csv')
+    sqlite_path = os.path.join(workdir, 'contention.db')
+    store = _open_store(backend, lessons_csv, contacts_csv, sqlite_path)
+    store.save_lessons([dict(l, status='available', filled_by='', filled_at='')
+                        for l in make_lessons(lessons, filled_ratio=0)])
+    paths = (backend, lessons_csv, contacts_csv, sqlite_path)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        # Let the workers finish starting up so it is not counted as claim time
+        pool.map(abs, range(workers))
+        start = time.perf_counter()
+        wins = pool.map(_claim_worker, [paths + (range(1, lessons + 1), w) for w in range(workers)])
+        claim_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        added = pool.map(_add_worker, [paths + (lessons // workers or 1, w) for w in range(workers)])
+        add_seconds = time.perf_counter() - start
+    claimed = [lesson_id for won in wins for lesson_id in won]
+    ids = [lesson_id for batch in added for lesson_id in batch]
+    return {
+        'workers': workers,
+        'claim_attempts': workers * lessons,
+        'claims_per_s': round(workers * lessons / claim_seconds, 2),
+        'lessons_claimed': len(set(map(str, claimed))),
+        'double_claims': len(claimed) - len(set(map(str, claimed))),
+        'lessons_added': len(ids),
+        'adds_per_s': round(len(ids) / add_seconds, 2),
+        'duplicate_ids': len(ids) - len(set(ids)),
+        'ok': len(claimed) == lessons and len(set(map(str, claimed))) == lessons and len(ids) == len(set(ids))
+    }
+
+
+# --- Pipeline scenarios ---
+def run_pipeline(args, workdir):
+    # Imported here so the spawned contention workers do not load Streamlit
+    import streamlit as st
+    import revisions
+    import tokens
+    # Session state is used outside a script run on purpose; silence the per-access warning
+    logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').setLevel(logging.ERROR)
+
+    smtp = FakeSMTPServer(latency=args.smtp_latency).start()
+    revisions.EMAIL_CONFIG.update(smtp_server='127.0.0.1', smtp_port=smtp.port, email=SMTP_USER,
+                                  password='benchmark', starttls=False, bcc_batch_size=args.bcc_batch_size)
+    revisions.TWILIO_CONFIG.update(transport='fake', fake_latency=args.sms_latency,
+                                   fake_rate_limit=args.sms_provider_limit,
+                                   account_sid='bench', auth_token='bench', phone_number='+15550000000')
+    revisions.RATE_LIMIT_CONFIG.update(email_rate=args.email_rate, email_burst=args.email_rate,
+                                       sms_rate=args.sms_rate, sms_burst=args.sms_rate)
+    revisions.CLAIM_LINK_CONFIG['secret'] = CLAIM_SECRET
+    revisions.LESSONS_CSV = os.path.join(workdir, 'canceled_lessons_log.csv')
+    revisions.CONTACTS_CSV = os.path.join(workdir, 'contacts.csv')
+    revisions.STORAGE_CONFIG.update(backend=args.backend, sqlite_path=os.path.join(workdir, 'lessons.db'))
+    revisions.OUTBOX_CONFIG.update(path=os.path.join(workdir, 'outbox.db'),
+                                   ledger_path=os.path.join(workdir, 'outbox.db'))
+
+    contacts = make_contacts(args.contacts)
+    lessons = make_lessons(args.lessons)
+    store = revisions.get_store()
+    store.save_contacts(contacts)
+    store.save_lessons(lessons)
+    st.session_state.notification_log = []
+
+    results = {}
+    cold_store = lambda: _open_store(args.backend, revisions.LESSONS_CSV, revisions.CONTACTS_CSV,
+                                     revisions.STORAGE_CONFIG['sqlite_path'])
+    results['load_lessons_cold'] = measure(lambda i: cold_store().load_lessons(), args.repeat, len(lessons))
+    results['load_lessons_cached'] = measure(lambda i: revisions.load_lessons_from_csv(), args.repeat, len(lessons))
+    results['save_lessons'] = measure(lambda i: revisions.save_lessons_to_csv(lessons), args.repeat, len(lessons))
+    results['get_csv_stats'] = measure(lambda i: revisions.get_csv_stats(), args.repeat)
+
+    # Fresh available lessons for the announcement and claim scenarios
+    fresh = []
+    for i in range(args.repeat + 1):
+        lesson = dict(make_lessons(1, seed=i)[0], id=None, status='available', filled_by='', filled_at='')
+        lesson['date'] = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
+        revisions.record_lesson_created(lesson)
+        fresh.append(lesson)
+
+    per_announcement = sum(bool(c.get('email')) + bool(c.get('phone')) for c in contacts)
+    # Delivering a whole announcement, as the outbox worker does for one wave
+    sent_before = smtp.messages
+    results['announce_send'] = measure(
+        lambda i: revisions.send_notifications(revisions.build_available_slot_messages(fresh[i], contacts)),
+        args.repeat, per_announcement
+    )
+    results['announce_send']['emails_received'] = smtp.messages - sent_before
+    results['announce_send']['sms_throttled'] = revisions.get_sms_client().transport.throttled
+
+    # The Fill page: verify the signed link, look up contact and lesson, then claim
+    links = [tokens.sign(CLAIM_SECRET, lesson['id'], contacts[i % len(contacts)]['contact_id'],
+                         time.time() + 3600) for i, lesson in enumerate(fresh)]
+    claimed = []
+
+    def claim_flow(i):
+        valid, claim = revisions.read_claim_params({'t': links[i]})
+        if not valid:
+            return
+        lesson_id, contact_id = claim
+        contact = revisions.get_contact_index().get(contact_id)
+        lesson = revisions.get_lesson(lesson_id)
+        if contact and lesson and lesson['status'] == 'available':
+            won, result = revisions.claim_lesson(lesson_id, contact['name'])
+            if won:
+                claimed.append((result, contact))
+
+    results['fill_lesson_claim'] = measure(claim_flow, args.repeat)
+    results['fill_lesson_claim']['claims_won'] = len(claimed)
+
+    index = revisions.get_contact_index()
+    sent_before = smtp.messages
+    results['notify_lesson_filled'] = measure(
+        lambda i: revisions.notify_lesson_filled(claimed[i][0], claimed[i][1],
+                                                 index.others(claimed[i][1]['contact_id'])),
+        min(args.repeat, len(claimed) - 1), per_announcement
+    )
+    results['notify_lesson_filled']['emails_received'] = smtp.messages - sent_before
+
+    # Queueing an announcement (what the dashboard waits for); runs last because the
+    # outbox worker then delivers it in the background
+    results['notify_available_slot'] = measure(
+        lambda i: revisions.notify_available_slot(fresh[i]), args.repeat, per_announcement
+    )
+    revisions.get_outbox().stop(timeout=5)
+    smtp.shutdown()
+    smtp.server_close()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the p50 change of every scenario against an earlier results file"""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+    print(f"\nChange in p50 latency vs {baseline_path}:")
+    for name, result in results.items():
+        old = baseline.get(name, {}).get('p50_ms')
+        if old and result.get('p50_ms') is not None:
+            print(f"  {name:<24} {old:>10.3f} ms -> {result['p50_ms']:>10.3f} ms  ({(result['p50_ms'] / old - 1) * 100:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cancellation-to-fill pipeline")
+    parser.add_argument('--contacts', type=int, default=1000)
+    parser.add_argument('--lessons', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5, help="timed iterations per scenario")
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help="seconds the fake SMTP server takes per message")
+    parser.add_argument('--sms-latency', type=float, default=0.0, help="seconds the fake SMS provider takes per message")
+    parser.add_argument('--email-rate', type=float, default=0, help="email sends per second (0 = unlimited)")
+    parser.add_argument('--sms-rate', type=float, default=0, help="SMS sends per second (0 = unlimited)")
+    parser.add_argument('--sms-provider-limit', type=int, default=0,
+                        help="SMS per second the fake provider accepts before replying 429 (0 = unlimited)")
+    parser.add_argument('--bcc-batch-size', type=int, default=0, help="BCC group size for 'lesson filled' emails")
+    parser.add_argument('--workers', type=int, default=8, help="processes in the claim contention scenario")
+    parser.add_argument('--contention-lessons', type=int, default=50)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_pipeline(args, workdir)
+        results['claim_contention'] = run_contention(args.backend, workdir, args.workers, args.contention_lessons)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        print(f"{name}: {json.dumps(result)}")
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+    return 0 if results['claim_contention']['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
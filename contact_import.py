@@ -0,0 +1,154 @@
+"""Validating contact import for roster CSV files.
+
+``import_contacts`` reads an uploaded or on-disk CSV in chunks of
+``chunk_size`` rows, so only one chunk of raw text is in memory at a time.
+Each row is cleaned before it is kept:
+
+* every cell is read as text, so phone numbers and ids keep their leading
+  ``+`` and zeros;
+* phones are normalised to E.164 (``+16175551212``), and national numbers
+  get ``default_country_code``; numbers in a country with a fixed national
+  number length (10 digits for +1) must have exactly that many digits, so a
+  7-digit local number without its area code is rejected;
+* emails are checked and normalised with email-validator;
+* rows that repeat an earlier row's contact_id, email or phone are dropped,
+  and the first row wins.
+
+Rows without a contact_id, a name or any usable email or phone are
+rejected. An email or phone that is present but invalid is blanked. Both
+cases are listed in the result's ``issues`` so they can be fixed in the
+source file.
+"""
+import re
+
+import pandas as pd
+from email_validator import EmailNotValidError, SPECIAL_USE_DOMAIN_NAMES, validate_email
+
+from repository import CONTACT_FIELDS, Contact
+
+REQUIRED_COLUMNS = ['contact_id', 'name']
+# Only this many issues are kept for the report; the rest are only counted
+MAX_REPORTED_ISSUES = 1000
+
+_PHONE_FORMATTING = re.compile(r'[\s().\-/]')
+# Digits after the country code, for countries where every number has the same length
+NATIONAL_NUMBER_LENGTHS = {'1': 10}
+# Plain ASCII addresses that email-validator would accept unchanged apart from the
+# domain's case; anything else goes through email-validator itself
+_SIMPLE_EMAIL = re.compile(
+    r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@((?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+([A-Za-z]{2,63}))"
+)
+
+
+def normalize_phone(phone, default_country_code='1'):
+    """Return the phone number in E.164 form, or None if it cannot be one"""
+    text = _PHONE_FORMATTING.sub('', phone)
+    if text.startswith('+'):
+        digits = text[1:]
+    elif text.startswith('00'):
+        digits = text[2:]
+    else:
+        digits = text
+        if digits.startswith('0'):
+            # National trunk prefix, e.g. 07700 900123 in the UK
+            digits = default_country_code + digits[1:]
+        elif not (digits.startswith(default_country_code) and len(digits) > 10):
+            digits = default_country_code + digits
+    if not digits.isdigit() or not 8 <= len(digits) <= 15 or digits[0] == '0':
+        return None
+    national_length = NATIONAL_NUMBER_LENGTHS.get(default_country_code)
+    if national_length and digits.startswith(default_country_code) \
+            and len(digits) - len(default_country_code) != national_length:
+        return None
+    return '+' + digits
+
+
+def normalize_email(email):
+    """Return the normalised email address, or None if it is not valid"""
+    match = _SIMPLE_EMAIL.fullmatch(email)
+    if match and len(email) <= 254 and email.index('@') <= 64 \
+            and match.group(2).lower() not in SPECIAL_USE_DOMAIN_NAMES:
+        return email[:match.start(1)] + match.group(1).lower()
+    try:
+        return validate_email(email, check_deliverability=False).normalized
+    except EmailNotValidError:
+        return None
+
+
+class ImportResult:
+    """Outcome of one import: the clean roster as Contacts, plus what was dropped or changed"""
+
+    def __init__(self):
+        self.contacts = []
+        self.issues = []  # dicts with row (CSV line number), contact_id and problem
+        self.issue_count = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.rows = 0
+
+    def report(self, row, contact_id, problem):
+        self.issue_count += 1
+        if len(self.issues) < MAX_REPORTED_ISSUES:
+            self.issues.append({'row': row, 'contact_id': contact_id, 'problem': problem})
+
+    def summary(self):
+        return (f"{len(self.contacts)} of {self.rows} rows imported, {self.rejected} rejected, "
+                f"{self.duplicates} duplicates dropped, {self.issue_count} issues")
+
+
+def import_contacts(source, chunk_size=5000, default_country_code='1'):
+    """Read a contacts CSV (path or file object) into an ImportResult.
+
+    Raises ValueError if the file lacks a required column.
+    """
+    result = ImportResult()
+    seen = {'contact_id': {}, 'email': {}, 'phone': {}}
+    reader = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_size,
+                         encoding='utf-8-sig', skipinitialspace=True)
+    line = 1  # the header
+    for chunk in reader:
+        chunk.columns = [str(column).strip().lower() for column in chunk.columns]
+        missing = [column for column in REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"Contacts file is missing required columns: {', '.join(missing)}")
+        columns = [column for column in CONTACT_FIELDS if column in chunk.columns]
+        for values in chunk[columns].itertuples(index=False, name=None):
+            line += 1
+            result.rows += 1
+            contact = {column: '' for column in CONTACT_FIELDS}
+            contact.update((column, value.strip()) for column, value in zip(columns, values))
+            contact_id = contact['contact_id']
+            if not contact_id or not contact['name']:
+                result.rejected += 1
+                result.report(line, contact_id, "missing contact_id or name")
+                continue
+            if contact['email']:
+                email = normalize_email(contact['email'])
+                if email is None:
+                    result.report(line, contact_id, f"invalid email {contact['email']!r} ignored")
+                contact['email'] = email or ''
+            if contact['phone']:
+                phone = normalize_phone(contact['phone'], default_country_code)
+                if phone is None:
+                    result.report(line, contact_id, f"invalid phone {contact['phone']!r} ignored")
+                contact['phone'] = phone or ''
+            if not contact['email'] and not contact['phone']:
+                result.rejected += 1
+                result.report(line, contact_id, "no valid email or phone")
+                continue
+            duplicate = next(
+                ((field, seen[field][contact[field].lower()]) for field in seen
+                 if contact[field] and contact[field].lower() in seen[field]),
+                None
+            )
+            if duplicate is not None:
+                field, first_line = duplicate
+                result.duplicates += 1
+                result.report(line, contact_id, f"duplicate {field} of row {first_line}")
+                continue
+            for field in seen:
+                if contact[field]:
+                    seen[field][contact[field].lower()] = line
+            result.contacts.append(Contact(contact))
+    return result
@@ -0,0 +1,60 @@
+"""Concurrent fan-out of notification messages.
+
+Each channel ('email', 'sms') gets its own bounded worker pool so a slow
+provider cannot starve the other one. Pools are process-wide and reused
+across Streamlit reruns.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(channel, max_workers):
+    """Return the shared worker pool for a channel"""
+    key = (channel, max_workers)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            executor = _executors[key] = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix=f"notify-{channel}"
+            )
+        return executor
+
+
+def _safe_send(send, message):
+    try:
+        return send(message)
+    except Exception as e:
+        return False, f"{message['channel']} error: {str(e)}"
+
+
+def dispatch(messages, send, limits, batch_senders=None):
+    """Send messages concurrently and return their (success, msg) results in order.
+
+    ``send(message)`` is called from a worker of the message's channel pool,
+    whose size is taken from ``limits[message['channel']]``. Channels listed in
+    ``batch_senders`` are instead handed over in one call as a list of
+    messages, while the other channels are already sending.
+    """
+    batch_senders = batch_senders or {}
+    results = [None] * len(messages)
+    futures = []
+    batches = {}
+    for i, m in enumerate(messages):
+        if m['channel'] in batch_senders:
+            batches.setdefault(m['channel'], []).append(i)
+        else:
+            executor = get_executor(m['channel'], limits.get(m['channel'], 1))
+            futures.append((i, executor.submit(_safe_send, send, m)))
+    for channel, positions in batches.items():
+        try:
+            outcomes = batch_senders[channel]([messages[i] for i in positions])
+        except Exception as e:
+            outcomes = [(False, f"{channel} error: {str(e)}")] * len(positions)
+        for i, outcome in zip(positions, outcomes):
+            results[i] = outcome
+    for i, future in futures:
+        results[i] = future.result()
+    return results
@@ -0,0 +1,167 @@
+"""Persistent delivery ledger that makes notifications at-most-once.
+
+Every notification about a lesson is identified by (lesson, contact_id,
+channel, kind), where the lesson is the store's id followed by the lesson
+id: a restarted memory store, a recreated database or a switch of backend
+hands out lesson ids from 1 again, and must not find the old lessons'
+deliveries. Right before a send, ``reserve`` records the keys it is
+about to deliver with ``INSERT OR IGNORE`` and returns only those that were
+not recorded yet. A rerun that rebuilds the same messages, an outbox job
+picked up again or a duplicate from another server process therefore finds
+its keys taken and sends nothing. ``release`` removes the keys of a send
+that failed, so a later attempt can go out.
+
+Keys only match for the same lesson. A double-submitted cancellation form
+would create a second lesson with new keys, so the form guards against
+that itself with a per-form key in the session.
+
+Keys already seen for a lesson are kept in memory, loaded with one indexed
+query the first time the lesson comes up, so a reserve with no cached keys
+goes straight to the insert. Cached keys can be stale, as another process
+may have released them, so before skipping a cached key its lesson's rows
+are read again; a duplicate costs that read instead of a write transaction.
+A send whose process dies after
+``reserve`` is not retried; a missed message is preferred over a duplicate
+paid text.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    lesson_id TEXT NOT NULL,
+    contact_id TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (lesson_id, contact_id, channel, kind)
+) WITHOUT ROWID;
+"""
+
+
+def delivery_key(store_id, lesson_id, contact_id, channel, kind):
+    return f'{store_id}:{lesson_id}', str(contact_id), channel, kind
+
+
+class DeliveryLedger:
+    """Deliveries recorded in a SQLite file, with an in-memory cache per lesson"""
+
+    def __init__(self, path, cached_lessons=64):
+        self.path = path
+        self.cached_lessons = cached_lessons
+        self._known = OrderedDict()  # lesson_id -> {(contact_id, channel, kind)}, most recent last
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _load(self, conn, lesson_ids, refresh=False):
+        """Make sure the recorded keys of these lessons are cached; returns the lessons read.
+
+        With ``refresh`` every lesson is read again, dropping keys that were
+        released elsewhere. Missing a key in the cache is harmless, since the
+        insert finds it; only a stale key would wrongly skip a send.
+        """
+        with self._lock:
+            missing = [lesson_id for lesson_id in lesson_ids if refresh or lesson_id not in self._known]
+        for lesson_id in missing:
+            rows = conn.execute(
+                "SELECT contact_id, channel, kind FROM deliveries WHERE lesson_id = ?", (lesson_id,)
+            ).fetchall()
+            with self._lock:
+                if refresh:
+                    self._known[lesson_id] = set(rows)
+                else:
+                    self._known.setdefault(lesson_id, set()).update(rows)
+        with self._lock:
+            for lesson_id in lesson_ids:
+                if lesson_id in self._known:
+                    self._known.move_to_end(lesson_id)
+            while len(self._known) > self.cached_lessons:
+                self._known.popitem(last=False)
+        return set(missing)
+
+    def _is_known(self, key):
+        known = self._known.get(key[0])
+        return known is not None and key[1:] in known
+
+    def reserve(self, keys):
+        """Record deliveries about to be made; returns the keys that had not been recorded before"""
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return []
+        conn = self._connect()
+        try:
+            loaded = self._load(conn, {key[0] for key in keys})
+            with self._lock:
+                hits = {key[0] for key in keys if self._is_known(key)} - loaded
+            if hits:
+                # Confirm the cached keys before skipping them
+                self._load(conn, hits, refresh=True)
+            with self._lock:
+                candidates = [key for key in keys if not self._is_known(key)]
+            if not candidates:
+                return []
+            now = time.time()
+            with self._transaction(conn):
+                fresh = [
+                    key for key in candidates
+                    if conn.execute("INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, ?, ?)", key + (now,)).rowcount
+                ]
+        finally:
+            conn.close()
+        # Candidates that were not fresh were recorded by another process meanwhile
+        with self._lock:
+            for key in candidates:
+                self._known.setdefault(key[0], set()).add(key[1:])
+        return fresh
+
+    def release(self, keys):
+        """Forget deliveries that did not happen, so they can be attempted again"""
+        keys = list(keys)
+        if not keys:
+            return
+        conn = self._connect()
+        try:
+            with self._transaction(conn):
+                conn.executemany(
+                    "DELETE FROM deliveries WHERE lesson_id = ? AND contact_id = ? AND channel = ? AND kind = ?", keys
+                )
+        finally:
+            conn.close()
+        with self._lock:
+            for key in keys:
+                known = self._known.get(key[0])
+                if known is not None:
+                    known.discard(key[1:])
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(path):
+    """Return the process-wide ledger for a database file, creating it on first use"""
+    with _ledgers_lock:
+        ledger = _ledgers.get(path)
+        if ledger is None:
+            ledger = _ledgers[path] = DeliveryLedger(path)
+        return ledger
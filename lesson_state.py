@@ -0,0 +1,143 @@
+"""Shared, versioned view of the lessons for every session in the process.
+
+Sessions used to keep their own copy of every lesson in
+``st.session_state`` and only reloaded it at session start. ``LessonState``
+replaces those copies with one read-only snapshot per process, rebuilt only
+when the store changes. A snapshot holds what the pages show, the available
+lessons and the most recent fills, read with the store's indexed queries
+rather than by loading the whole history. A change is noticed right away when it is made
+through this object, and otherwise within ``poll_interval`` seconds, because
+a watcher thread compares the store's ``version()`` token. That token is
+derived from the files, so the watcher also sees writes made by other
+sessions and by other server processes sharing the same store.
+
+Each change bumps ``revision`` and calls the subscribed callbacks with the
+new revision. Pages compare revisions to decide whether to rerun.
+"""
+import threading
+from types import MappingProxyType
+
+
+class LessonSnapshot:
+    """Immutable lessons at one revision: every available lesson and the most recent fills.
+
+    ``filled`` holds at most the state's ``recent_filled`` lessons, latest
+    lesson date first; ``filled_total`` counts all of them.
+    """
+
+    def __init__(self, revision, available=(), filled=(), filled_total=None):
+        self.revision = revision
+        self.available = tuple(MappingProxyType(dict(lesson)) for lesson in available)
+        self.filled = tuple(MappingProxyType(dict(lesson)) for lesson in filled)
+        self.filled_total = len(self.filled) if filled_total is None else filled_total
+
+
+class LessonState:
+    """Process-wide lesson state over a store, with revisions and change subscriptions"""
+
+    def __init__(self, store, poll_interval=2.0, recent_filled=20):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.recent_filled = recent_filled
+        self.revision = 0
+        self._version = None
+        self._snapshot = None
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.refresh()
+
+    def refresh(self):
+        """Check the store for changes; returns the current revision"""
+        version = self.store.version()
+        with self._lock:
+            if version == self._version:
+                return self.revision
+            self._version = version
+            self.revision += 1
+            self._snapshot = None
+            revision = self.revision
+            subscribers = list(self._subscribers)
+            self._changed.notify_all()
+        for callback in subscribers:
+            try:
+                callback(revision)
+            except Exception:
+                pass
+        return revision
+
+    def snapshot(self):
+        """Return the LessonSnapshot for the current revision, building it once per change"""
+        with self._lock:
+            if self._snapshot is None or self._snapshot.revision != self.revision:
+                filled, filled_total = self.store.lesson_page(status='filled', limit=self.recent_filled)
+                self._snapshot = LessonSnapshot(self.revision, self.store.available_lessons(), filled, filled_total)
+            return self._snapshot
+
+    def subscribe(self, callback):
+        """Call ``callback(revision)`` after every change; returns a function that unsubscribes"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def wait_for_change(self, revision, timeout=None):
+        """Block until the revision moves past ``revision`` or the timeout ends; returns the revision"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.revision != revision, timeout)
+            return self.revision
+
+    # --- Writes go through the store, then publish the change at once ---
+    def add_lesson(self, lesson):
+        lesson_id = self.store.add_lesson(lesson)
+        self.refresh()
+        return lesson_id
+
+    def claim_lesson(self, lesson_id, filled_by, filled_at):
+        lesson = self.store.claim_lesson(lesson_id, filled_by, filled_at)
+        if lesson is not None:
+            self.refresh()
+        return lesson
+
+    def save_lessons(self, lessons):
+        self.store.save_lessons(lessons)
+        self.refresh()
+
+    # --- Watcher for changes made elsewhere ---
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception:
+                pass
+
+    def start(self):
+        """Start the background watcher if it is not already running"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._watch, name="lesson-state-watcher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def get_state(store, poll_interval=2.0, recent_filled=20):
+    """Return the process-wide LessonState for a store, starting its watcher on first use"""
+    with _states_lock:
+        state = _states.get(id(store))
+        if state is None or state.store is not store:
+            state = _states[id(store)] = LessonState(store, poll_interval=poll_interval, recent_filled=recent_filled)
+            state.start()
+        return state
@@ -0,0 +1,180 @@
+"""Lightweight timing and counter instrumentation.
+
+Timers record call count, total and maximum duration per name; counters are
+plain running totals. Everything is process-wide, so the numbers cover every
+session and the background workers. Instrumentation is off until
+``configure(enabled=True)``; while off, ``timed`` functions pay one flag
+check and ``timer``/``laps`` hand back shared no-op objects.
+
+``prometheus_text`` renders the current values in the Prometheus text
+exposition format, and ``write_prometheus`` writes them atomically to a
+file, e.g. for node_exporter's textfile collector.
+"""
+from contextlib import nullcontext
+from functools import wraps
+import os
+import re
+import tempfile
+import threading
+import time
+
+PREFIX = 'lesson_manager'
+
+_enabled = False
+_lock = threading.Lock()
+_timers = {}  # name -> [count, total seconds, max seconds]
+_counters = {}  # name -> value
+_NULL_TIMER = nullcontext()
+
+
+def configure(enabled):
+    """Turn instrumentation on or off for the whole process"""
+    global _enabled
+    _enabled = bool(enabled)
+
+
+def enabled():
+    return _enabled
+
+
+def record(name, seconds):
+    """Add one timed call to a timer"""
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+
+def count(name, amount=1):
+    """Add to a counter; does nothing while instrumentation is off"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timer(name):
+    """Context manager that times its block under ``name``"""
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def timed(name):
+    """Decorator that times every call of a function under ``name``"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class Laps:
+    """Times consecutive sections of a long function without re-indenting it.
+
+    Each ``lap(section)`` records the time since the previous lap (or since
+    creation) under ``<name>.<section>``.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._last = time.perf_counter()
+
+    def lap(self, section):
+        now = time.perf_counter()
+        record(f"{self.name}.{section}", now - self._last)
+        self._last = now
+
+
+class _NullLaps:
+    def lap(self, section):
+        pass
+
+
+_NULL_LAPS = _NullLaps()
+
+
+def laps(name):
+    """Return a Laps stopwatch, or a no-op one while instrumentation is off"""
+    return Laps(name) if _enabled else _NULL_LAPS
+
+
+def snapshot():
+    """Return (timers, counters): timer rows sorted by total time, and a copy of the counters"""
+    with _lock:
+        timers = [
+            {'name': name, 'calls': calls, 'total_ms': round(total * 1000, 3),
+             'mean_ms': round(total / calls * 1000, 3), 'max_ms': round(longest * 1000, 3)}
+            for name, (calls, total, longest) in _timers.items()
+        ]
+        counters = dict(_counters)
+    timers.sort(key=lambda row: row['total_ms'], reverse=True)
+    return timers, counters
+
+
+def reset():
+    """Clear every timer and counter"""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def _metric_name(name):
+    return f"{PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+
+def prometheus_text():
+    """Render timers and counters in the Prometheus text exposition format"""
+    with _lock:
+        timers = {name: list(stats) for name, stats in _timers.items()}
+        counters = dict(_counters)
+    lines = []
+    for name in sorted(timers):
+        calls, total, longest = timers[name]
+        metric = _metric_name(name) + '_seconds'
+        lines.append(f"# TYPE {metric} summary")
+        lines.append(f"{metric}_count {calls}")
+        lines.append(f"{metric}_sum {total:.6f}")
+        lines.append(f"# TYPE {metric}_max gauge")
+        lines.append(f"{metric}_max {longest:.6f}")
+    for name in sorted(counters):
+        metric = _metric_name(name) + '_total'
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {counters[name]}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """Atomically write the current metrics to ``path`` in Prometheus text format"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(prometheus_text())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
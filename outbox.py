@@ -0,0 +1,297 @@
+"""Durable, file-backed outbox for notification messages.
+
+The cancellation form enqueues one job per message and returns at once. A
+background worker thread drains due jobs through the dispatcher and retries
+failures with exponential backoff, so a browser refresh can no longer cut
+an announcement off halfway.
+
+Jobs carry the message ``kind`` and ``contact_id`` so pending jobs of one
+kind can be cancelled for a lesson, e.g. later announcement waves once the
+lesson has been claimed.
+
+A sender returns ``(None, msg)`` when the provider throttled the message or
+no send slot was free. Such a job goes back to 'pending' without using up
+an attempt, and is retried after ``retry_delay(message)`` seconds.
+"""
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+import time
+
+import dispatcher
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lesson_id TEXT,
+    channel TEXT NOT NULL,
+    label TEXT NOT NULL,
+    message TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT '',
+    contact_id TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_result TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_lesson ON outbox (lesson_id, status);
+CREATE INDEX IF NOT EXISTS idx_outbox_updated ON outbox (updated_at);
+CREATE TABLE IF NOT EXISTS outbox_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Columns added after the first release, created on open for older queue files
+ADDED_COLUMNS = {
+    'kind': "TEXT NOT NULL DEFAULT ''",
+    'contact_id': "TEXT"
+}
+
+
+def _lesson_key(lesson_id):
+    return None if lesson_id is None else str(lesson_id)
+
+
+class Outbox:
+    """A queue of notification jobs stored in a SQLite file.
+
+    Job status moves from 'pending' to 'sending' while a worker holds it and
+    ends as 'sent' or, after ``max_attempts`` failures, 'failed'. Jobs left in
+    'sending' by a crashed process are picked up again after ``lease`` seconds.
+    Jobs cancelled with ``cancel``, or for which ``skip(message)`` returns True
+    when they come due, end as 'cancelled' without being sent.
+    """
+
+    def __init__(self, path, send, limits, max_attempts=5, base_delay=2.0, max_delay=300.0,
+                 batch_size=50, poll_interval=1.0, lease=300.0, batch_senders=None, skip=None, retry_delay=None):
+        self.path = path
+        self.send = send
+        self.skip = skip
+        self.retry_delay = retry_delay
+        self.limits = limits
+        self.batch_senders = batch_senders
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        conn = self._connect()
+        try:
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            if existing:
+                for column, definition in ADDED_COLUMNS.items():
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {definition}")
+            conn.executescript(SCHEMA)
+            # When this queue file started tracking recipients; older lessons were announced without it
+            conn.execute("INSERT OR IGNORE INTO outbox_meta VALUES ('created_at', ?)", (repr(time.time()),))
+            self.created_at = float(conn.execute(
+                "SELECT value FROM outbox_meta WHERE key = 'created_at'"
+            ).fetchone()[0])
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        """Hold the database write lock for the whole block"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def enqueue(self, messages, delay=0):
+        """Add messages to the queue and wake the worker; returns the number queued.
+
+        ``messages`` may be any iterable; it is consumed lazily so large
+        announcements are never held in memory as a whole.
+        """
+        now = time.time()
+        queued = 0
+
+        def rows():
+            nonlocal queued
+            for m in messages:
+                queued += 1
+                yield (_lesson_key(m.get('lesson_id')), m['channel'], m['label'], json.dumps(m),
+                       m.get('kind', ''), _lesson_key(m.get('contact_id')), now + delay, now, now)
+
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO outbox (lesson_id, channel, label, message, kind, contact_id, next_attempt_at, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows()
+            )
+        self._wake.set()
+        return queued
+
+    def _claim_due(self):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = 'pending', updated_at = ? WHERE status = 'sending' AND updated_at < ?",
+                (now, now - self.lease)
+            )
+            jobs = conn.execute(
+                "SELECT id, attempts, message FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at, id LIMIT ?",
+                (now, self.batch_size)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', updated_at = ? WHERE id = ?",
+                [(now, job_id) for job_id, _, _ in jobs]
+            )
+        return jobs
+
+    def run_once(self):
+        """Send one batch of due jobs; returns how many were processed"""
+        jobs = self._claim_due()
+        if not jobs:
+            return 0
+        messages = [json.loads(message) for _, _, message in jobs]
+        updates = []
+        if self.skip is not None:
+            now = time.time()
+            keep = []
+            for job, message in zip(jobs, messages):
+                if self.skip(message):
+                    updates.append(('cancelled', job[1], now, "Skipped: no longer needed", now, job[0]))
+                else:
+                    keep.append((job, message))
+            jobs = [job for job, _ in keep]
+            messages = [message for _, message in keep]
+        outcomes = dispatcher.dispatch(messages, self.send, self.limits, self.batch_senders)
+        now = time.time()
+        for (job_id, attempts, _), message, (success, msg) in zip(jobs, messages, outcomes):
+            if success is None:
+                # Throttled: wait until the provider accepts sends again, without using up an attempt
+                delay = max(self.base_delay, self.retry_delay(message) if self.retry_delay else 0)
+                updates.append(('pending', attempts, now + delay, msg, now, job_id))
+                continue
+            attempts += 1
+            if success:
+                updates.append(('sent', attempts, now, msg, now, job_id))
+            elif attempts >= self.max_attempts:
+                updates.append(('failed', attempts, now, msg, now, job_id))
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                updates.append(('pending', attempts, now + delay, msg, now, job_id))
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_result = ?, updated_at = ? "
+                "WHERE id = ?",
+                updates
+            )
+        return len(updates)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = self.run_once()
+            except sqlite3.Error:
+                processed = 0
+            if not processed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def start(self):
+        """Start the background worker if it is not already running"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background worker after its current batch"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def cancel(self, lesson_id, kind=None):
+        """Cancel a lesson's jobs that are still waiting, optionally only one kind; returns the count"""
+        query = "UPDATE outbox SET status = 'cancelled', updated_at = ? WHERE lesson_id = ? AND status = 'pending'"
+        params = [time.time(), _lesson_key(lesson_id)]
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        with self._transaction() as conn:
+            return conn.execute(query, params).rowcount
+
+    def notified(self, lesson_id, kind):
+        """Return the ids of contacts with a job of ``kind`` for a lesson that was sent or is being sent"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT DISTINCT contact_id FROM outbox WHERE lesson_id = ? AND kind = ? "
+                "AND status IN ('sending', 'sent') AND contact_id IS NOT NULL",
+                (_lesson_key(lesson_id), kind)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {contact_id for contact_id, in rows}
+
+    def progress(self, lesson_id=None):
+        """Return job counts by status, optionally for a single lesson"""
+        counts = {'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0, 'cancelled': 0}
+        query = "SELECT status, COUNT(*) FROM outbox"
+        params = ()
+        if lesson_id is not None:
+            query += " WHERE lesson_id = ?"
+            params = (_lesson_key(lesson_id),)
+        conn = self._connect()
+        try:
+            for status, count in conn.execute(query + " GROUP BY status", params):
+                counts[status] = count
+        finally:
+            conn.close()
+        return counts
+
+    def recent(self, limit=20):
+        """Return the most recently updated jobs as dicts, newest first"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT updated_at, label, status, attempts, last_result FROM outbox "
+                "ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {'updated_at': updated_at, 'label': label, 'status': status, 'attempts': attempts,
+             'result': last_result}
+            for updated_at, label, status, attempts, last_result in rows
+        ]
+
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_outbox(path, send, limits, **options):
+    """Return the process-wide outbox for a queue file, creating it on first use"""
+    with _outboxes_lock:
+        box = _outboxes.get(path)
+        if box is None:
+            box = _outboxes[path] = Outbox(path, send, limits, **options)
+        return box
@@ -1,6 +1,4 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime
 import os
 import sys
 
@@ -10,11 +8,15 @@ sys.path.append(parent_dir)
 
 # Import helper functions from revisions.py
 try:
-    from revisions import save_lessons_to_csv, get_week_dates, send_email, send_sms, log_notification, notify_lesson_filled, EMAIL_CONFIG, TWILIO_CONFIG, load_lessons_from_csv
+    from revisions import claim_lesson, get_week_dates, send_email, send_sms, log_notification, notify_lesson_filled, EMAIL_CONFIG, TWILIO_CONFIG, get_lesson, get_contact_index, get_lesson_state, read_claim_params, announced_contacts
 except ImportError:
     st.error("Could not load functions from revisions.py. Please check your project structure.")
     st.stop()
 
+def claimed_by(lesson, contact):
+    """True if the lesson has already been filled by this contact"""
+    return lesson['status'] == 'filled' and lesson.get('filled_by') == contact['name']
+
 # --- Main Page Logic ---
 def fill_lesson_page():
     st.set_page_config(
@@ -28,31 +30,33 @@ def fill_lesson_page():
     
     st.title("✅ Fencing Lesson Availability")
 
-    # Get lesson_id and contact_id from the URL parameters
     params = st.query_params
-    lesson_id = params.get('lesson_id')
-    contact_id = params.get('contact_id')
-
-    # Load data
-    lessons = st.session_state.get('canceled_lessons', load_lessons_from_csv())
-    contacts = st.session_state.get('contacts_db')
-    
-    if not contacts:
-        # Load contacts if not already in session state
-        try:
-            contacts_df = pd.read_csv("contacts.csv")
-            contacts = contacts_df.to_dict('records')
-        except Exception as e:
-            st.warning("Contacts data not loaded. Functionality will be limited.")
 
     # --- Check if a specific lesson was requested via URL ---
-    if lesson_id and contact_id:
+    if params.get('t') or params.get('lesson_id') or params.get('contact_id'):
         st.subheader("Confirm Your Lesson Slot")
-        
-        selected_contact = next((c for c in contacts if str(c.get('contact_id')) == contact_id), None)
-        lesson_to_fill = next((l for l in lessons if str(l['id']) == lesson_id and l['status'] == 'available'), None)
 
-        if not lesson_to_fill or not selected_contact:
+        # Check the link's signature and expiry before touching storage
+        valid, claim = read_claim_params(params)
+        if not valid:
+            if claim == "expired":
+                st.error("This link has expired.")
+            else:
+                st.error("This lesson is no longer available or the link is invalid.")
+            return
+        lesson_id, contact_id = claim
+
+        # Indexed lookups: no scan over every lesson or member
+        contacts = get_contact_index()
+        if not len(contacts):
+            st.warning("Contacts data not loaded. Functionality will be limited.")
+        selected_contact = contacts.get(contact_id)
+        lesson_to_fill = get_lesson(lesson_id)
+
+        if lesson_to_fill and selected_contact and claimed_by(lesson_to_fill, selected_contact):
+            st.success("🎉 This lesson is already confirmed for you.")
+            return
+        if not lesson_to_fill or lesson_to_fill['status'] != 'available' or not selected_contact:
             st.error("This lesson is no longer available or the link is invalid.")
             return
 
@@ -67,33 +71,38 @@ def fill_lesson_page():
 
         if st.button("✅ Confirm and Fill This Lesson"):
             with st.spinner("Confirming lesson and sending notifications..."):
-                # Update the lesson's status in the session state
-                lesson_to_fill['status'] = 'filled'
-                lesson_to_fill['filled_by'] = selected_contact['name']
-                lesson_to_fill['filled_at'] = datetime.now().strftime('%Y-%m-%d %H:%M')
+                # Check and set in one atomic step so only one claimant can win
+                claimed, result = claim_lesson(lesson_to_fill['id'], selected_contact['name'])
+                if not claimed:
+                    if result is None:
+                        # A second click by the winner also lands here: check who filled it
+                        lesson_now = get_lesson(lesson_to_fill['id'])
+                        if lesson_now and claimed_by(lesson_now, selected_contact):
+                            st.success("🎉 This lesson is already confirmed for you.")
+                        else:
+                            st.error("Sorry, this lesson has already been taken by another member.")
+                    else:
+                        st.error("There was an error updating the lesson log.")
+                    return
 
-                # Save the entire updated list to the CSV
-                csv_success, csv_msg = save_lessons_to_csv(lessons)
-                
                 # Send notifications
-                remaining_contacts = [c for c in contacts if str(c.get('contact_id')) != contact_id]
-                notify_lesson_filled(lesson_to_fill, selected_contact, remaining_contacts)
+                # Only members who were told about the slot hear that it has been filled;
+                # waves that had not gone out yet were cancelled by the claim
+                remaining_contacts = announced_contacts(result, contacts, exclude=contact_id)
+                notify_lesson_filled(result, selected_contact, remaining_contacts)
+
+                st.success("🎉 Success! Your lesson has been confirmed.")
+                log_notification("Lesson filled via external link.")
 
-                if csv_success:
-                    st.success("🎉 Success! Your lesson has been confirmed.")
-                    log_notification("Lesson filled via external link.")
-                else:
-                    st.error("There was an error updating the lesson log.")
-                
                 st.button("Close")
     
     else:
         # --- If no specific lesson is in the URL, show all available lessons ---
         st.subheader("Available Lessons Calendar")
-        available_lessons = [l for l in lessons if l['status'] == 'available']
+        available_lessons = get_lesson_state().snapshot().available
         if available_lessons:
             # Sort by date and time
-            sorted_lessons = sorted(available_lessons, key=lambda x: (x['date'], x['time']))
+            sorted_lessons = sorted(available_lessons, key=lambda x: (str(x['date']), x['time']))
             for lesson in sorted_lessons:
                 st.markdown(f"**{lesson['date']} at {lesson['time']}** with Coach {lesson['coach']}")
                 st.write(f"_Originally scheduled for {lesson['original_student']}_")
@@ -0,0 +1,160 @@
+"""Adaptive token-bucket rate limiting for the notification providers.
+
+Each provider (the SMTP account, the Twilio account) gets one process-wide
+``AdaptiveLimiter``. It lets sends through at up to ``rate`` per second,
+with bursts of up to ``burst``. When the provider pushes back (SMTP 421/45x,
+HTTP 429), ``throttled`` halves the current rate and pauses every send on
+that provider for the provider's Retry-After, or for an exponentially
+growing pause if none was given. Each later success adds back a twentieth
+of the configured rate, so throughput settles just below what the provider
+accepts instead of bursting into repeated blocks.
+
+Limits are per server process; when several processes share one account,
+divide the configured rates between them.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
+
+import metrics
+
+
+class RateLimited(Exception):
+    """No send slot became free within the caller's wait limit"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} rate limit, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Seconds to wait from an HTTP Retry-After value (seconds or a date), or None if absent or invalid"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class AdaptiveLimiter:
+    """Token bucket whose refill rate backs off on throttling and recovers on success"""
+
+    def __init__(self, name, rate, burst=None, min_rate=None, base_pause=1.0, max_pause=60.0):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = float(burst or max(1.0, rate))
+        self.min_rate = float(min_rate if min_rate is not None else self.max_rate / 20)
+        self.base_pause = base_pause
+        self.max_pause = max_pause
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._strikes = 0  # throttles since the last success
+        self._lock = threading.Lock()
+        self.stats = {'sent': 0, 'waited': 0.0, 'throttled': 0, 'deferred': 0}
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait_time(self, now):
+        """Seconds until a token is free; caller holds the lock"""
+        self._refill(now)
+        wait = max(0.0, self._paused_until - now)
+        if self._tokens < 1:
+            wait = max(wait, (1 - self._tokens) / self.rate)
+        return wait
+
+    def acquire(self, timeout=None):
+        """Take one send slot, waiting for it; raises RateLimited if that takes longer than ``timeout``"""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    self._tokens -= 1
+                    self.stats['sent'] += 1
+                    self.stats['waited'] += now - started
+                    return
+                if timeout is not None and now - started + wait > timeout:
+                    self.stats['deferred'] += 1
+                    metrics.count(f'{self.name}_deferred')
+                    raise RateLimited(self.name, wait)
+            time.sleep(min(wait, 1.0))
+
+    def retry_after(self):
+        """Seconds until the next send slot is expected to be free"""
+        with self._lock:
+            return self._wait_time(time.monotonic())
+
+    def throttled(self, retry_after=None):
+        """Record a throttling response: halve the rate and pause all sends"""
+        with self._lock:
+            self._strikes += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                retry_after = min(self.max_pause, self.base_pause * 2 ** (self._strikes - 1))
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + retry_after)
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            self.stats['throttled'] += 1
+        metrics.count(f'{self.name}_throttled')
+
+    def succeeded(self):
+        """Record an accepted send, recovering the rate a step towards its configured maximum"""
+        with self._lock:
+            self._strikes = 0
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class _Unlimited:
+    """Stand-in used when a provider has no configured rate"""
+
+    name = 'unlimited'
+    rate = max_rate = 0
+    stats = {}
+
+    def acquire(self, timeout=None):
+        pass
+
+    def retry_after(self):
+        return 0.0
+
+    def throttled(self, retry_after=None):
+        pass
+
+    def succeeded(self):
+        pass
+
+
+UNLIMITED = _Unlimited()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name, rate, burst=None, **options):
+    """Return the process-wide limiter for a provider; a rate of 0 means unlimited"""
+    if not rate:
+        return UNLIMITED
+    key = (name, rate, burst)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = AdaptiveLimiter(name, rate, burst, **options)
+        return limiter
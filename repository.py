@@ -0,0 +1,334 @@
+"""In-memory indexes over lessons and contacts.
+
+The stores keep their cached lessons in a ``LessonIndex`` and contacts in a
+``ContactIndex``, so looking up a claim link's lesson and contact is a dict
+lookup instead of a scan over every lesson and member. All mutations go
+through the index methods, which keep every index in step.
+
+Contacts may carry lesson preferences in optional columns: ``coaches`` and
+``weekdays`` (lists separated by ``;``) and a ``time_from``/``time_to``
+window. An empty value means "any". ``AudienceIndex`` resolves which
+contacts a lesson should be announced to by intersecting precomputed sets
+instead of checking every contact.
+
+A ``ContactIndex`` is immutable once built, and its members are compact
+read-only ``Contact`` records. That lets the stores hand one roster to every
+session, and replace it by swapping in a new index when contacts are saved.
+"""
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+import re
+import sys
+
+PREFERENCE_FIELDS = ['coaches', 'weekdays', 'time_from', 'time_to']
+CONTACT_FIELDS = ['contact_id', 'name', 'email', 'phone'] + PREFERENCE_FIELDS
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def lesson_key(lesson_id):
+    """Normalise lesson ids so 3, '3' and numpy integers index the same lesson"""
+    return str(lesson_id)
+
+
+def contact_key(contact_id):
+    """Normalise contact ids from CSV (int), SQLite (text) and URLs (text)"""
+    return str(contact_id)
+
+
+def _text(value):
+    """Return a preference cell as stripped text, treating None and NaN as empty"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return str(value).strip()
+
+
+def _split(value):
+    return [part.strip() for part in re.split(r'[;,|]', _text(value)) if part.strip()]
+
+
+def _minutes(value):
+    """Return 'HH:MM' as minutes after midnight, or None if it is empty or unreadable"""
+    try:
+        hours, minutes = _text(value).split(':')[:2]
+        return int(hours) * 60 + int(minutes)
+    except ValueError:
+        return None
+
+
+def parse_preferences(contact):
+    """Return a contact's (coaches, weekdays, window); each is None when unrestricted.
+
+    Coaches are casefolded names, weekdays are 0 (Monday) to 6, and the window
+    is an inclusive (start, end) pair in minutes after midnight.
+    """
+    coaches = frozenset(name.casefold() for name in _split(contact.get('coaches'))) or None
+    weekdays = frozenset(
+        WEEKDAYS.index(day[:3].lower()) for day in _split(contact.get('weekdays')) if day[:3].lower() in WEEKDAYS
+    ) or None
+    start, end = _minutes(contact.get('time_from')), _minutes(contact.get('time_to'))
+    window = None
+    if start is not None or end is not None:
+        window = (start if start is not None else 0, end if end is not None else 24 * 60)
+    return coaches, weekdays, window
+
+
+def _lesson_weekday(lesson):
+    try:
+        return datetime.strptime(str(lesson.get('date'))[:10], '%Y-%m-%d').weekday()
+    except ValueError:
+        return None
+
+
+class AudienceIndex:
+    """Contact positions keyed by coach, weekday and time slot.
+
+    Every key maps to the contacts that accept it, including those with no
+    restriction on that dimension, so the audience of a lesson is the
+    intersection of three precomputed sets.
+    """
+
+    def __init__(self, contacts):
+        self._contacts = contacts
+        self._windows = {}  # position -> window, for contacts that set one
+        self._open_coach, self._open_weekday, self._open_time = set(), set(), set()
+        self._by_coach, self._by_weekday = {}, {day: set() for day in range(7)}
+        for position, contact in enumerate(contacts):
+            coaches, weekdays, window = parse_preferences(contact)
+            if coaches is None:
+                self._open_coach.add(position)
+            else:
+                for coach in coaches:
+                    self._by_coach.setdefault(coach, set()).add(position)
+            for day in (range(7) if weekdays is None else weekdays):
+                self._by_weekday[day].add(position)
+            if window is None:
+                self._open_time.add(position)
+            else:
+                self._windows[position] = window
+        for positions in self._by_coach.values():
+            positions |= self._open_coach
+        self._by_slot = {}  # filled per lesson time on first use; there are only a few slots
+
+    def _slot(self, slot):
+        positions = self._by_slot.get(slot)
+        if positions is None:
+            minutes = _minutes(slot)
+            positions = set(self._open_time)
+            positions.update(
+                position for position, (start, end) in self._windows.items()
+                if minutes is None or start <= minutes <= end
+            )
+            self._by_slot[slot] = positions
+        return positions
+
+    def eligible(self, lesson):
+        """Return the contacts who could take ``lesson``, in contact-list order"""
+        weekday = _lesson_weekday(lesson)
+        candidates = [
+            self._by_coach.get(_text(lesson.get('coach')).casefold(), self._open_coach),
+            self._by_weekday[weekday] if weekday is not None else None,
+            self._slot(_text(lesson.get('time')))
+        ]
+        candidates = sorted((c for c in candidates if c is not None), key=len)
+        positions = candidates[0].intersection(*candidates[1:])
+        return [self._contacts[position] for position in sorted(positions)]
+
+
+class LessonIndex:
+    """Lessons indexed by id and by status, in insertion order.
+
+    For paging, each lesson is also kept in lists sorted by date and time:
+    one over all lessons, one per status, per coach and per status and coach.
+    A page is then a date-range bisect and a slice, and the coach list a
+    count per coach, however long the history is.
+    """
+
+    def __init__(self, lessons=()):
+        self._by_id = {}
+        self._by_status = {}
+        self._sorted = {}  # (status or None, coach or None) -> sorted entries
+        self._entries = {}  # key -> (date, time, -seq, key)
+        self._coaches = {}  # coach -> number of lessons
+        self._seq = 0
+        self.max_id = 0  # highest numeric lesson id seen
+        for lesson in lessons:
+            self.add(lesson)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, lesson_id):
+        return lesson_key(lesson_id) in self._by_id
+
+    def values(self):
+        return self._by_id.values()
+
+    def get(self, lesson_id):
+        return self._by_id.get(lesson_key(lesson_id))
+
+    def add(self, lesson):
+        """Add a lesson unless one with the same id exists; returns True if added"""
+        key = lesson_key(lesson['id'])
+        if key in self._by_id:
+            return False
+        self._by_id[key] = lesson
+        self._by_status.setdefault(lesson['status'], {})[key] = lesson
+        self._seq += 1
+        # Ties on date and time page in insertion order, as a stable sort would
+        self._entries[key] = (str(lesson['date']), str(lesson['time']), -self._seq, key)
+        self._sort(lesson, key)
+        try:
+            self.max_id = max(self.max_id, int(lesson['id']))
+        except (TypeError, ValueError):
+            pass
+        return True
+
+    def update(self, lesson_id, **fields):
+        """Update a lesson's fields, moving it between status indexes as needed"""
+        key = lesson_key(lesson_id)
+        lesson = self._by_id[key]
+        old_status = lesson['status']
+        self._unsort(lesson, key)
+        lesson.update(fields)
+        if lesson['status'] != old_status:
+            del self._by_status[old_status][key]
+            self._by_status.setdefault(lesson['status'], {})[key] = lesson
+        entry = self._entries[key]
+        self._entries[key] = (str(lesson['date']), str(lesson['time'])) + entry[2:]
+        self._sort(lesson, key)
+        return lesson
+
+    def _lists(self, lesson):
+        status, coach = lesson['status'], lesson['coach']
+        return [(None, None), (status, None), (None, coach), (status, coach)]
+
+    def _sort(self, lesson, key):
+        entry = self._entries[key]
+        for name in self._lists(lesson):
+            insort(self._sorted.setdefault(name, []), entry)
+        coach = lesson['coach']
+        self._coaches[coach] = self._coaches.get(coach, 0) + 1
+
+    def _unsort(self, lesson, key):
+        entry = self._entries[key]
+        for name in self._lists(lesson):
+            entries = self._sorted[name]
+            del entries[bisect_left(entries, entry)]
+        coach = lesson['coach']
+        self._coaches[coach] -= 1
+        if not self._coaches[coach]:
+            del self._coaches[coach]
+
+    def with_status(self, status):
+        """Return the lessons with a status, in insertion order"""
+        return list(self._by_status.get(status, {}).values())
+
+    def count(self, status):
+        return len(self._by_status.get(status, {}))
+
+    def coaches(self):
+        """Return the coaches that have lessons, sorted"""
+        return sorted({str(coach) for coach in self._coaches})
+
+    def page(self, start_date=None, end_date=None, coach=None, status=None, offset=0, limit=50):
+        """Return (lessons, total): matching lessons, latest date and time first.
+
+        Dates are compared on their first ten characters (YYYY-MM-DD) and the
+        range is inclusive. Callers must not modify the returned lessons.
+        """
+        entries = self._sorted.get((status or None, coach), [])
+        lo = bisect_left(entries, (start_date,)) if start_date is not None else 0
+        # Any date with a time part still sorts before the next day
+        hi = bisect_right(entries, (end_date + '\uffff',)) if end_date is not None else len(entries)
+        total = max(hi - lo, 0)
+        stop = max(hi - offset, lo)
+        start = max(stop - limit, lo)
+        return [self._by_id[entry[3]] for entry in reversed(entries[start:stop])], total
+
+
+class Contact:
+    """One roster member as a read-only record with dict-style access.
+
+    Slots instead of a per-contact dict keep a large roster to a fraction of
+    the memory, and ``get``/``[]``/``keys`` let code written for contact dicts
+    (and ``dict(contact)``) keep working. Values are stripped text, with ''
+    for missing ones.
+    """
+
+    __slots__ = tuple(CONTACT_FIELDS)
+
+    def __init__(self, contact):
+        for field in CONTACT_FIELDS:
+            value = _text(contact.get(field))
+            if field in PREFERENCE_FIELDS:
+                # Members share a handful of preference values
+                value = sys.intern(value)
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Contact records are read-only")
+
+    def __getitem__(self, field):
+        if field not in CONTACT_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in CONTACT_FIELDS else default
+
+    def keys(self):
+        return list(CONTACT_FIELDS)
+
+    def __contains__(self, field):
+        return field in CONTACT_FIELDS
+
+    def __eq__(self, other):
+        if not isinstance(other, Contact):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in CONTACT_FIELDS)
+
+    def __hash__(self):
+        return hash(self.contact_id)
+
+    def __repr__(self):
+        return f"Contact({dict(self)!r})"
+
+
+class ContactIndex:
+    """Immutable roster of Contacts indexed by contact id, by name and by lesson preferences"""
+
+    def __init__(self, contacts=()):
+        self.contacts = tuple(c if isinstance(c, Contact) else Contact(c) for c in contacts)
+        self._audience = None
+        self._by_id = {}
+        self._by_name = {}
+        for contact in self.contacts:
+            self._by_id.setdefault(contact.contact_id, contact)
+            self._by_name.setdefault(contact.name, contact)
+
+    def __len__(self):
+        return len(self.contacts)
+
+    def __iter__(self):
+        return iter(self.contacts)
+
+    def get(self, contact_id):
+        return self._by_id.get(contact_key(contact_id))
+
+    def find_by_name(self, name):
+        return self._by_name.get(name)
+
+    def others(self, contact_id):
+        """Return every contact except the one with ``contact_id``"""
+        key = contact_key(contact_id)
+        return [c for c in self.contacts if c.contact_id != key]
+
+    def eligible(self, lesson, exclude=None):
+        """Return the contacts whose preferences allow ``lesson``, optionally leaving one out"""
+        if self._audience is None:
+            self._audience = AudienceIndex(self.contacts)
+        contacts = self._audience.eligible(lesson)
+        if exclude is not None:
+            key = contact_key(exclude)
+            contacts = [c for c in contacts if c.contact_id != key]
+        return contacts
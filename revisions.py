@@ -1,12 +1,24 @@
 import streamlit as st
 import pandas as pd
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from twilio.rest import Client
 import os
+import heapq
+import uuid
 from datetime import datetime, timedelta
-import time
+import smtp_pool
+import sms_client
+import dispatcher
+import outbox
+import storage
+import lesson_state
+import repository
+import templates
+import tokens
+import metrics
+import rate_limit
+import contact_import
+import ledger
 
 # --- Configuration ---
 # Your secrets are now loaded from the secrets.toml file
@@ -14,74 +26,285 @@ EMAIL_CONFIG = {
     'smtp_server': st.secrets.get('smtp_server', 'smtp.gmail.com'),
     'smtp_port': st.secrets.get('smtp_port', 587),
     'email': st.secrets.get('email_address', ''),
-    'password': st.secrets.get('email_password', '')
+    'password': st.secrets.get('email_password', ''),
+    'pool_size': st.secrets.get('smtp_pool_size', 4),
+    'idle_timeout': st.secrets.get('smtp_idle_timeout', 60),
+    'starttls': st.secrets.get('smtp_starttls', True),
+    # Send identical "lesson filled" notices as BCC groups of this size; 0 sends one email per contact
+    'bcc_batch_size': st.secrets.get('email_bcc_batch_size', 0)
 }
 
 TWILIO_CONFIG = {
     'account_sid': st.secrets.get('twilio_account_sid', ''),
     'auth_token': st.secrets.get('twilio_auth_token', ''),
-    'phone_number': st.secrets.get('twilio_phone', '')
+    'phone_number': st.secrets.get('twilio_phone', ''),
+    # 'fake' records messages in memory instead of calling Twilio
+    'transport': st.secrets.get('sms_transport', 'twilio'),
+    'fake_latency': st.secrets.get('sms_fake_latency', 0.0),
+    # Fake only: reply 429 to sends beyond this many per second, to exercise throttling
+    'fake_rate_limit': st.secrets.get('sms_fake_rate_limit', 0)
 }
 
+# Concurrent sends per channel when notifying contacts
+NOTIFY_CONFIG = {
+    'email': st.secrets.get('email_workers', 4),
+    'sms': st.secrets.get('sms_workers', 8)
+}
+
+# Sends per second and burst size per provider (0 = unlimited). Throttling replies
+# halve the rate for a while; a send that cannot get a slot within max_wait seconds
+# is rescheduled through the outbox instead of dropped
+RATE_LIMIT_CONFIG = {
+    'email_rate': st.secrets.get('email_rate_limit', 5),
+    'email_burst': st.secrets.get('email_rate_burst', 10),
+    'sms_rate': st.secrets.get('sms_rate_limit', 10),
+    'sms_burst': st.secrets.get('sms_rate_burst', 20),
+    'max_wait': st.secrets.get('rate_limit_max_wait', 30)
+}
+
+# Background delivery queue for announcements
+OUTBOX_CONFIG = {
+    'path': st.secrets.get('outbox_path', 'notification_outbox.db'),
+    'max_attempts': st.secrets.get('outbox_max_attempts', 5),
+    # Record of lesson notifications already sent, checked before each send to drop duplicates
+    'ledger_path': st.secrets.get('delivery_ledger_path', 'notification_outbox.db')
+}
+
+# Announcements go out in waves of this many contacts, one wave per interval (seconds),
+# until the lesson is claimed; a size of 0 announces to everyone at once
+WAVE_CONFIG = {
+    'size': st.secrets.get('announcement_wave_size', 0),
+    'interval': st.secrets.get('announcement_wave_interval', 600)
+}
+
+# How often an open dashboard checks the store for changes when auto-refresh is on
+REFRESH_INTERVAL = st.secrets.get('refresh_interval', 30)
+# How often the shared lesson state checks the store for writes made by other processes
+STATE_POLL_INTERVAL = st.secrets.get('lesson_state_poll_interval', 2)
+
 # IMPORTANT: You must set this to your deployed app's URL
 # Example: https://your-app-name.streamlit.app
 BASE_URL = st.secrets.get('app_url', 'http://localhost:8501')
 
-# --- Helper functions (using CSV files) ---
+# Claim links carry an HMAC-signed token when a secret is set; without one the
+# legacy lesson_id/contact_id links are used
+CLAIM_LINK_CONFIG = {
+    'secret': st.secrets.get('claim_link_secret', ''),
+    # Used when a lesson's start time cannot be read from its date and time
+    'fallback_ttl_hours': st.secrets.get('claim_link_ttl_hours', 168)
+}
+
+# Timing and counter instrumentation for the developer panel
+METRICS_CONFIG = {
+    'enabled': st.secrets.get('metrics_enabled', False),
+    # If set, the Prometheus text file is rewritten after every page run
+    'path': st.secrets.get('metrics_path', '')
+}
+metrics.configure(METRICS_CONFIG['enabled'])
+
+# Uploaded contact lists are validated this many rows at a time; phone numbers
+# without a country code get default_country_code
+CONTACT_IMPORT_CONFIG = {
+    'chunk_size': st.secrets.get('contact_import_chunk_size', 5000),
+    'default_country_code': str(st.secrets.get('default_country_code', '1'))
+}
+
+# Rows per page in the Full Lessons Log
+LOG_PAGE_SIZES = [25, 50, 100]
+# Filled lessons listed individually on the dashboard
+RECENT_FILLED_LIMIT = 20
+# Available lessons listed individually on the dashboard, soonest first
+UPCOMING_AVAILABLE_LIMIT = 50
+
+# Storage backend: "csv" (snapshot plus append-only event log), "sqlite", or "memory"
+# (nothing persisted; for tests and demos)
+LESSONS_CSV = "canceled_lessons_log.csv"
+CONTACTS_CSV = "contacts.csv"
+STORAGE_CONFIG = {
+    'backend': st.secrets.get('storage_backend', 'csv'),
+    'sqlite_path': st.secrets.get('sqlite_path', 'lessons.db'),
+    'compact_every': st.secrets.get('lesson_log_compact_every', 500)
+}
+
+# --- Helper functions (using the configured store) ---
+def get_store():
+    """Return the shared lesson and contact store"""
+    return storage.get_store(
+        STORAGE_CONFIG['backend'],
+        lessons_csv=LESSONS_CSV,
+        contacts_csv=CONTACTS_CSV,
+        sqlite_path=STORAGE_CONFIG['sqlite_path'],
+        compact_every=STORAGE_CONFIG['compact_every']
+    )
+
+def get_lesson_state():
+    """Return the lesson state shared by every session in this process"""
+    return lesson_state.get_state(get_store(), poll_interval=STATE_POLL_INTERVAL, recent_filled=RECENT_FILLED_LIMIT)
+
+def _storage_location():
+    if STORAGE_CONFIG['backend'] == 'sqlite':
+        return STORAGE_CONFIG['sqlite_path']
+    if STORAGE_CONFIG['backend'] == 'memory':
+        return "memory"
+    return LESSONS_CSV
+
+def _storage_error(e):
+    if isinstance(e, PermissionError):
+        return f"PermissionError: Please close the '{_storage_location()}' file if it's open in another program."
+    return f"CSV logging error: {str(e)}"
+
+@metrics.timed('load_lessons')
 def load_lessons_from_csv():
-    """Load lessons from the CSV file."""
-    csv_filename = "canceled_lessons_log.csv"
-    if not os.path.exists(csv_filename):
-        return []
+    """Load lessons from the configured store."""
     try:
-        df = pd.read_csv(csv_filename)
-        # Handle datetime conversion to avoid future errors
-        df['date entered'] = pd.to_datetime(df['date entered'])
-        # Convert DataFrame back to a list of dictionaries
-        lessons = df.to_dict('records')
-        # Rename keys to be consistent with the app's internal format
-        for lesson in lessons:
-            lesson['id'] = lesson.pop('lesson_id')
-            lesson['date'] = lesson.pop('lesson date')
-            lesson['original_student'] = lesson.pop('fencer')
-            lesson['created_at'] = lesson.pop('date entered')
-            lesson['filled_by'] = lesson.get('filled by', '')
-            lesson['filled_at'] = lesson.get('filled at', '')
-        return lessons
-    except pd.errors.EmptyDataError:
-        return []
+        return get_store().load_lessons()
     except Exception as e:
         st.error(f"Error loading CSV file: {str(e)}")
         return []
 
+@metrics.timed('save_lessons')
 def save_lessons_to_csv(lessons_list):
-    """Save the full list of lessons to CSV, overwriting the file"""
-    csv_filename = "canceled_lessons_log.csv"
-    
-    # Prepare data for CSV
-    rows = []
-    for lesson in lessons_list:
-        row = {
-            'lesson_id': lesson['id'],
-            'date entered': lesson['created_at'],
-            'lesson date': lesson['date'],
-            'time': lesson['time'],
-            'coach': lesson['coach'],
-            'fencer': lesson['original_student'],
-            'status': lesson['status'],
-            'filled by': lesson.get('filled_by', ''),
-            'filled at': lesson.get('filled_at', ''),
-        }
-        rows.append(row)
-    
-    df = pd.DataFrame(rows)
+    """Save the full list of lessons, atomically replacing the stored copy"""
+    try:
+        get_lesson_state().save_lessons(lessons_list)
+        return True, f"Lessons saved to {_storage_location()}"
+    except Exception as e:
+        return False, _storage_error(e)
+
+@metrics.timed('record_lesson_created')
+def record_lesson_created(lesson):
+    """Add a new cancellation to the store, which assigns its id if it has none"""
+    try:
+        get_lesson_state().add_lesson(lesson)
+        return True, f"Lesson {lesson['id']} logged to {_storage_location()}"
+    except Exception as e:
+        return False, _storage_error(e)
+
+@metrics.timed('claim_lesson')
+def claim_lesson(lesson_id, filled_by):
+    """Atomically fill a lesson if it is still available.
+
+    Returns (True, lesson) for the single winning claimant, (False, None) if
+    the lesson was already taken or does not exist, and (False, message) if
+    the store could not be updated.
+    """
+    try:
+        lesson = get_lesson_state().claim_lesson(lesson_id, filled_by, datetime.now().strftime('%Y-%m-%d %H:%M'))
+    except Exception as e:
+        return False, _storage_error(e)
+    if lesson is not None:
+        cancel_announcements(lesson_id)
+    return lesson is not None, lesson
+
+def get_lesson(lesson_id):
+    """Look up a single lesson by id in the store's index"""
+    try:
+        return get_store().get_lesson(lesson_id)
+    except Exception as e:
+        st.error(f"Error loading lesson: {str(e)}")
+        return None
+
+def get_contact_index():
+    """Return the saved roster, one immutable ContactIndex shared by every session"""
+    try:
+        return get_store().contact_index()
+    except Exception as e:
+        st.warning(f"Error loading contacts: {str(e)}")
+        return repository.ContactIndex()
+
+@metrics.timed('import_contacts')
+def import_contacts(source):
+    """Validate a contacts CSV and save the clean roster to the store.
+
+    Returns (True, ImportResult) once saved, (False, ImportResult) if no row
+    passed validation, in which case the existing roster is kept, or
+    (False, message) if the file could not be read or the roster saved.
+    """
+    try:
+        result = contact_import.import_contacts(
+            source,
+            chunk_size=CONTACT_IMPORT_CONFIG['chunk_size'],
+            default_country_code=CONTACT_IMPORT_CONFIG['default_country_code']
+        )
+    except (ValueError, pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        return False, f"Error reading contacts: {str(e)}"
+    if not result.contacts:
+        return False, result
     try:
-        df.to_csv(csv_filename, index=False)
-        return True, f"Lessons saved to {csv_filename}"
-    except PermissionError:
-        return False, f"PermissionError: Please close the '{csv_filename}' file if it's open in another program."
+        get_store().save_contacts(result.contacts)
     except Exception as e:
-        return False, f"CSV logging error: {str(e)}"
+        return False, _storage_error(e)
+    return True, result
+
+def load_contacts():
+    """Load the saved contact list from the store"""
+    try:
+        return get_store().load_contacts()
+    except Exception as e:
+        st.warning(f"Error loading contacts: {str(e)}")
+        return []
+
+def lessons_export(**filters):
+    """Return the matching lessons as CSV bytes.
+
+    Passed as a callable to st.download_button, so the export is only built
+    when the button is clicked rather than on every rerun.
+    """
+    return ''.join(get_store().iter_export_csv(**filters)).encode('utf-8')
+
+def lessons_log_section():
+    """Render one filtered page of the lesson log instead of the whole history"""
+    st.header("📖 Full Lessons Log")
+    store = get_store()
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+    with col1:
+        date_range = st.date_input("Lesson dates", value=(), key="log_dates")
+    with col2:
+        coach = st.selectbox("Coach", ["All"] + store.coaches(), key="log_coach")
+    with col3:
+        status = st.selectbox("Status", ["All", "available", "filled"], key="log_status")
+    with col4:
+        page_size = st.selectbox("Rows per page", LOG_PAGE_SIZES, key="log_page_size")
+    filters = {
+        'start_date': date_range[0].isoformat() if len(date_range) > 0 else None,
+        'end_date': date_range[-1].isoformat() if len(date_range) > 0 else None,
+        'coach': None if coach == "All" else coach,
+        'status': None if status == "All" else status
+    }
+    # Start from the first page whenever the filters change
+    if st.session_state.get('log_filters') != (filters, page_size):
+        st.session_state.log_filters = (filters, page_size)
+        st.session_state.log_page = 0
+
+    page = st.session_state.log_page
+    lessons, total = store.lesson_page(offset=page * page_size, limit=page_size, **filters)
+    if total and not lessons:
+        # The log shrank under us; show its last page instead
+        page = st.session_state.log_page = (total - 1) // page_size
+        lessons, total = store.lesson_page(offset=page * page_size, limit=page_size, **filters)
+    if not total:
+        st.info("The lessons log is currently empty." if not any(filters.values()) else "No lessons match these filters.")
+        return
+    pages = (total + page_size - 1) // page_size
+    st.dataframe(pd.DataFrame(lessons), use_container_width=True, hide_index=True)
+    col1, col2, col3, col4 = st.columns([1, 2, 1, 2])
+    with col1:
+        if st.button("⬅️ Previous", disabled=page == 0, key="log_previous"):
+            st.session_state.log_page -= 1
+            st.rerun()
+    with col2:
+        st.write(f"Page {page + 1} of {pages} ({total} lessons)")
+    with col3:
+        if st.button("Next ➡️", disabled=page + 1 >= pages, key="log_next"):
+            st.session_state.log_page += 1
+            st.rerun()
+    with col4:
+        st.download_button(
+            label="📥 Download Filtered Log",
+            data=lambda: lessons_export(**filters),
+            file_name="fencing_lessons_log_filtered.csv",
+            mime="text/csv"
+        )
 
 def get_week_dates(start_date=None):
     """Get week dates starting from Sunday"""
@@ -118,171 +341,433 @@ def generate_time_slots():
         current_time += timedelta(minutes=30)
     return slots
 
-def send_email(to_email, subject, body):
-    """Send email notification"""
+def get_rate_limiter(channel):
+    """Return the shared rate limiter for a channel's provider"""
+    return rate_limit.get_limiter(channel, RATE_LIMIT_CONFIG[f'{channel}_rate'], RATE_LIMIT_CONFIG[f'{channel}_burst'])
+
+def get_smtp_pool():
+    """Return the shared SMTP connection pool for the configured account"""
+    return smtp_pool.get_pool(
+        EMAIL_CONFIG['smtp_server'],
+        EMAIL_CONFIG['smtp_port'],
+        EMAIL_CONFIG['email'],
+        EMAIL_CONFIG['password'],
+        max_size=EMAIL_CONFIG['pool_size'],
+        idle_timeout=EMAIL_CONFIG['idle_timeout'],
+        starttls=EMAIL_CONFIG['starttls'],
+        limiter=get_rate_limiter('email'),
+        max_wait=RATE_LIMIT_CONFIG['max_wait']
+    )
+
+@metrics.timed('send_email')
+def send_email(to_email, subject, body, html=None, bcc=None):
+    """Send email notification over a pooled SMTP session, with an optional HTML alternative.
+
+    With ``bcc``, one message goes to every listed address in a single SMTP
+    transaction; the addresses are never written into the headers. Returns
+    (None, msg) when the provider throttled the send, so it can be retried later.
+    """
     if not EMAIL_CONFIG['email'] or not EMAIL_CONFIG['password']:
         return False, "Email configuration not set"
     try:
-        msg = MIMEMultipart()
+        msg = MIMEMultipart('alternative') if html else MIMEMultipart()
         msg['From'] = EMAIL_CONFIG['email']
         msg['To'] = to_email
         msg['Subject'] = subject
         msg.attach(MIMEText(body, 'plain'))
-        server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-        server.starttls()
-        server.login(EMAIL_CONFIG['email'], EMAIL_CONFIG['password'])
-        server.send_message(msg)
-        server.quit()
+        if html:
+            msg.attach(MIMEText(html, 'html'))
+        refused = get_smtp_pool().send_message(msg, to_addrs=bcc)
+        if refused:
+            metrics.count('email_errors', len(refused))
+            return True, f"Email sent, {len(refused)} recipients refused: {', '.join(refused)}"
         return True, "Email sent successfully"
+    except rate_limit.RateLimited as e:
+        return None, f"Email deferred: {str(e)}"
     except Exception as e:
+        if smtp_pool.is_throttled(e):
+            return None, f"Email throttled by provider: {str(e)}"
+        metrics.count('email_errors')
         return False, f"Email error: {str(e)}"
 
+def sms_configured():
+    """Return True when SMS can be sent with the current configuration"""
+    if TWILIO_CONFIG['transport'] == 'fake':
+        return True
+    return bool(TWILIO_CONFIG['account_sid'] and TWILIO_CONFIG['auth_token'])
+
+def get_sms_client():
+    """Return the shared SMS client for the configured account"""
+    return sms_client.get_client(
+        TWILIO_CONFIG['account_sid'],
+        TWILIO_CONFIG['auth_token'],
+        TWILIO_CONFIG['phone_number'],
+        transport=TWILIO_CONFIG['transport'],
+        max_workers=NOTIFY_CONFIG['sms'],
+        fake_latency=TWILIO_CONFIG['fake_latency'],
+        fake_rate_limit=TWILIO_CONFIG['fake_rate_limit'],
+        limiter=get_rate_limiter('sms'),
+        max_wait=RATE_LIMIT_CONFIG['max_wait']
+    )
+
+@metrics.timed('send_sms')
 def send_sms(to_phone, message):
     """Send SMS notification"""
-    if not TWILIO_CONFIG['account_sid'] or not TWILIO_CONFIG['auth_token']:
+    if not sms_configured():
         return False, "SMS configuration not set"
-    try:
-        client = Client(TWILIO_CONFIG['account_sid'], TWILIO_CONFIG['auth_token'])
-        message = client.messages.create(
-            body=message,
-            from_=TWILIO_CONFIG['phone_number'],
-            to=to_phone
-        )
-        return True, "SMS sent successfully"
-    except Exception as e:
-        return False, f"SMS error: {str(e)}"
+    return get_sms_client().send(to_phone, message)
+
+@metrics.timed('send_sms_batch')
+def send_sms_batch(messages):
+    """Send a list of (phone, body) pairs in one call and return per-recipient results"""
+    if not sms_configured():
+        return [(False, "SMS configuration not set")] * len(messages)
+    return get_sms_client().send_batch(messages)
 
+@metrics.timed('get_csv_stats')
 def get_csv_stats():
-    """Calculate and return CSV log statistics based on new headers."""
+    """Return the lesson log statistics kept up to date by the store."""
     stats = {
         'total_cancellations': 0,
         'total_filled': 0,
         'fill_rate': 0.0,
         'recent_activity': 0
     }
-    csv_filename = "canceled_lessons_log.csv"
-    if os.path.exists(csv_filename):
-        try:
-            df = pd.read_csv(csv_filename)
-            stats['total_cancellations'] = len(df)
-            stats['total_filled'] = len(df[df['status'] == 'filled'])
-            if stats['total_cancellations'] > 0:
-                stats['fill_rate'] = round((stats['total_filled'] / stats['total_cancellations']) * 100, 2)
-            seven_days_ago = datetime.now() - timedelta(days=7)
-            
-            df['date entered'] = pd.to_datetime(df['date entered'])
-            stats['recent_activity'] = len(df[df['date entered'] >= seven_days_ago])
-        except pd.errors.EmptyDataError:
-            pass
-        except Exception as e:
-            st.error(f"Error calculating CSV stats: {str(e)}")
+    try:
+        stats.update(get_store().lesson_stats())
+    except Exception as e:
+        st.error(f"Error calculating CSV stats: {str(e)}")
     return stats
 
 def log_notification(message):
     """Log notifications to session state."""
     st.session_state.notification_log.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
 
-def notify_available_slot(lesson_info):
-    """Notify all contacts about available slot with a unique link"""
-    subject = f"🤺 Fencing Lesson Available with {lesson_info['coach']} - {lesson_info['date']} at {lesson_info['time']}"
-    
+def get_delivery_ledger():
+    """Return the shared ledger of lesson notifications already delivered"""
+    return ledger.get_ledger(OUTBOX_CONFIG['ledger_path'])
+
+def with_store_id(messages):
+    """Tag lesson messages with the current store's id, so their lesson ids stay unambiguous once queued"""
+    store_id = get_store().store_id
+    for message in messages:
+        yield dict(message, store_id=store_id) if 'store_id' not in message else message
+
+def delivery_keys(message):
+    """Return the ledger keys of a message, one per recipient; none for messages not about a lesson"""
+    if message.get('lesson_id') is None or not message.get('kind'):
+        return []
+    store_id = message.get('store_id') or get_store().store_id
+    contact_ids = message.get('contact_ids') or [message.get('contact_id')]
+    return [ledger.delivery_key(store_id, message['lesson_id'], contact_id, message['channel'], message['kind'])
+            for contact_id in contact_ids if contact_id is not None]
+
+def _send_message(message):
+    if message['channel'] == 'email':
+        return send_email(message['to'], message['subject'], message['body'], message.get('html'),
+                          message.get('bcc'))
+    return send_sms(message['to'], message['body'])
+
+def deliver_message(message):
+    """Send a single notification message over its channel, unless it was already delivered.
+
+    Recipients are reserved in the delivery ledger before the send and
+    released again if it fails or is deferred, so a retry can go out.
+    """
+    keys = delivery_keys(message)
+    fresh = get_delivery_ledger().reserve(keys) if keys else []
+    if len(fresh) < len(keys):
+        metrics.count('duplicates_suppressed', len(keys) - len(fresh))
+        if not fresh:
+            return True, "Already sent, skipped"
+        # Part of a BCC group was already told: send only to the rest
+        fresh_ids = {key[1] for key in fresh}
+        recipients = [(email, contact_id) for email, contact_id in zip(message['bcc'], message['contact_ids'])
+                      if repository.contact_key(contact_id) in fresh_ids]
+        message = dict(message, bcc=[email for email, _ in recipients],
+                       contact_ids=[contact_id for _, contact_id in recipients])
+    try:
+        success, msg = _send_message(message)
+    except Exception:
+        get_delivery_ledger().release(fresh)
+        raise
+    if not success:
+        get_delivery_ledger().release(fresh)
+    return success, msg
+
+def deliver_sms_batch(messages):
+    """Send SMS notification messages as a single batch, skipping those already delivered"""
+    delivery_ledger = get_delivery_ledger()
+    keyed = [delivery_keys(m) for m in messages]
+    fresh = set(delivery_ledger.reserve(key for keys in keyed for key in keys))
+    outcomes = [(True, "Already sent, skipped")] * len(messages)
+    to_send = []
+    for i, keys in enumerate(keyed):
+        owned = [key for key in keys if key in fresh]
+        if keys and not owned:
+            continue
+        # A key repeated later in the same batch is skipped there
+        fresh.difference_update(owned)
+        to_send.append((i, owned))
+    metrics.count('duplicates_suppressed', len(messages) - len(to_send))
+    if not to_send:
+        return outcomes
+    try:
+        results = send_sms_batch([(messages[i]['to'], messages[i]['body']) for i, _ in to_send])
+    except Exception:
+        delivery_ledger.release(key for _, owned in to_send for key in owned)
+        raise
+    unsent = []
+    for (i, owned), outcome in zip(to_send, results):
+        outcomes[i] = outcome
+        if not outcome[0]:
+            unsent.extend(owned)
+    delivery_ledger.release(unsent)
+    return outcomes
+
+# Channels that are handed to the dispatcher as one batch per announcement
+BATCH_SENDERS = {'sms': deliver_sms_batch}
+
+@metrics.timed('send_notifications')
+def send_notifications(messages):
+    """Send notification messages concurrently and log each result in order.
+
+    Messages the provider throttled are handed to the outbox to be retried
+    once the provider accepts sends again.
+    """
+    messages = list(with_store_id(messages))
     results = []
-    contacts_list = st.session_state.contacts_db
+    outcomes = dispatcher.dispatch(messages, deliver_message, NOTIFY_CONFIG, BATCH_SENDERS)
+    for message, (success, msg) in zip(messages, outcomes):
+        if success is None:
+            get_outbox().enqueue([message], delay=throttle_delay(message))
+            msg = f"{msg} (rescheduled)"
+        result_msg = f"{message['label']}: {msg}"
+        results.append(result_msg)
+        log_notification(result_msg)
+    return results
+
+def throttle_delay(message):
+    """Seconds until a throttled message's provider is expected to accept sends again"""
+    return get_rate_limiter(message['channel']).retry_after()
+
+def announcement_stale(message):
+    """True for an 'available' announcement whose lesson has been claimed or removed since it was queued"""
+    if message.get('kind') != 'available':
+        return False
+    try:
+        store = get_store()
+        if message.get('store_id', store.store_id) != store.store_id:
+            # Queued for a store that has since been replaced: its lesson is gone
+            return True
+        lesson = store.get_lesson(message['lesson_id'])
+    except Exception:
+        return False
+    return lesson is None or lesson['status'] != 'available'
+
+def get_outbox():
+    """Return the shared notification outbox, starting its worker if needed"""
+    box = outbox.get_outbox(
+        OUTBOX_CONFIG['path'],
+        deliver_message,
+        NOTIFY_CONFIG,
+        max_attempts=OUTBOX_CONFIG['max_attempts'],
+        batch_senders=BATCH_SENDERS,
+        skip=announcement_stale,
+        retry_delay=throttle_delay
+    )
+    box.start()
+    return box
+
+def lesson_start(lesson):
+    """Return a lesson's start as a datetime, or None if its date or time cannot be parsed"""
+    start = pd.to_datetime(f"{lesson.get('date')} {lesson.get('time')}", errors='coerce')
+    if pd.isna(start):
+        return None
+    return start.to_pydatetime()
+
+def claim_link_expiry(lesson):
+    """Claim links stop working once the lesson has started"""
+    start = lesson_start(lesson)
+    if start is None:
+        return datetime.now().timestamp() + CLAIM_LINK_CONFIG['fallback_ttl_hours'] * 3600
+    return start.timestamp()
+
+def claim_link(lesson_info, contact_id, expires_at=None):
+    """Return the Fill_Lesson link for one contact's claim on a lesson"""
+    if not CLAIM_LINK_CONFIG['secret']:
+        return f"{BASE_URL}/Fill_Lesson?lesson_id={lesson_info['id']}&contact_id={contact_id}"
+    if expires_at is None:
+        expires_at = claim_link_expiry(lesson_info)
+    token = tokens.sign(CLAIM_LINK_CONFIG['secret'], lesson_info['id'], contact_id, expires_at)
+    return f"{BASE_URL}/Fill_Lesson?t={token}"
+
+def read_claim_params(params):
+    """Return (True, (lesson_id, contact_id)) from a claim link's query parameters, or (False, reason).
+
+    Only the signature and expiry are checked here, so forged or stale links
+    are turned away without reading the store.
+    """
+    token = params.get('t')
+    if CLAIM_LINK_CONFIG['secret']:
+        if not token:
+            return False, "missing token"
+        return tokens.verify(CLAIM_LINK_CONFIG['secret'], token)
+    lesson_id, contact_id = params.get('lesson_id'), params.get('contact_id')
+    if not lesson_id or not contact_id:
+        return False, "missing lesson or contact"
+    return True, (lesson_id, contact_id)
+
+def build_available_slot_messages(lesson_info, contacts_list):
+    """Yield the email and SMS announcement messages for an available slot, one contact at a time"""
+    announcement = templates.AVAILABLE_SLOT.for_lesson(lesson_info)
+    expires_at = claim_link_expiry(lesson_info)
     for contact in contacts_list:
         contact_name = contact.get('name', 'Unknown')
-        
         # Create a unique link that points to the new page
-        fill_link = f"{BASE_URL}/Fill_Lesson?lesson_id={lesson_info['id']}&contact_id={contact.get('contact_id')}"
-        
-        email_body = f"""
-A fencing lesson slot has become available!
-
-📅 **Date:** {lesson_info['date']}
-⏰ **Time:** {lesson_info['time']} (25 minutes)
-👨‍🏫 **Coach:** {lesson_info['coach']}
-👤 **Originally Scheduled For:** {lesson_info['original_student']}
-
-To claim this lesson, simply click the link below:
-{fill_link}
-
-This slot is available on a first-come, first-served basis.
-
-Best regards,
-Your Fencing Coach
-        """
-        sms_body = f"🤺 Fencing lesson with {lesson_info['coach']} is available on {lesson_info['date']} at {lesson_info['time']}. Claim it now: {fill_link}"
-        
+        fill_link = claim_link(lesson_info, contact.get('contact_id'), expires_at)
+        email_body, email_html, sms_body = announcement.render(name=contact_name, fill_link=fill_link)
         if contact.get('email'):
-            email_success, email_msg = send_email(contact['email'], subject, email_body)
-            result_msg = f"Email to {contact_name}: {email_msg}"
-            results.append(result_msg)
-            log_notification(result_msg)
+            yield {'channel': 'email', 'to': contact['email'], 'subject': announcement.subject,
+                   'body': email_body, 'html': email_html, 'label': f"Email to {contact_name}",
+                   'lesson_id': lesson_info['id'], 'contact_id': contact.get('contact_id'), 'kind': 'available'}
         if contact.get('phone'):
-            sms_success, sms_msg = send_sms(contact['phone'], sms_body)
-            result_msg = f"SMS to {contact_name}: {sms_msg}"
-            results.append(result_msg)
-            log_notification(result_msg)
-    return results
+            yield {'channel': 'sms', 'to': contact['phone'], 'subject': announcement.subject,
+                   'body': sms_body, 'label': f"SMS to {contact_name}",
+                   'lesson_id': lesson_info['id'], 'contact_id': contact.get('contact_id'), 'kind': 'available'}
 
-def notify_lesson_filled(lesson_info, selected_contact, remaining_contacts):
-    """Notify about lesson being filled"""
-    confirm_subject = f"✅ Fencing Lesson Confirmed with {lesson_info['coach']} - {lesson_info['date']} at {lesson_info['time']}"
-    confirm_email = f"""
-Congratulations! Your fencing lesson has been confirmed:
-📅 **Date:** {lesson_info['date']}
-⏰ **Time:** {lesson_info['time']} (25 minutes)
-👨‍🏫 **Coach:** {lesson_info['coach']}
-Please arrive 5 minutes early. See you there!
-Best regards,
-Your Fencing Coach
-    """
-    confirm_sms = f"✅ Fencing lesson confirmed with {lesson_info['coach']} for {lesson_info['date']} at {lesson_info['time']}. Arrive 5 min early!"
-    filled_subject = f"❌ Fencing Lesson Filled with {lesson_info['coach']} - {lesson_info['date']} at {lesson_info['time']}"
-    filled_email = f"""
-The fencing lesson slot with {lesson_info['coach']} for {lesson_info['date']} at {lesson_info['time']} has been filled by another student.
-Thank you for your interest! We'll notify you of future available slots.
-Best regards,
-Your Fencing Coach
+def queue_announcement(lesson_info, audience):
+    """Queue a slot announcement in waves and return (messages queued, number of waves).
+
+    Contacts are announced to in ``audience`` order. Each later wave is
+    delayed by the wave interval and is dropped once the lesson is claimed,
+    so members further down the list are not told about a slot that is gone.
     """
-    filled_sms = f"❌ Fencing lesson with {lesson_info['coach']} on {lesson_info['date']} at {lesson['time']} has been filled. Thanks for your interest!"
-    results = []
+    size = WAVE_CONFIG['size'] or len(audience) or 1
+    box = get_outbox()
+    queued = waves = 0
+    for start in range(0, len(audience), size):
+        queued += box.enqueue(
+            with_store_id(build_available_slot_messages(lesson_info, audience[start:start + size])),
+            delay=waves * WAVE_CONFIG['interval']
+        )
+        waves += 1
+    metrics.count('notifications_queued', queued)
+    log_notification(f"Queued {queued} announcements for lesson {lesson_info['id']} in {waves} waves")
+    return queued, waves
+
+def cancel_announcements(lesson_id):
+    """Drop announcement waves for a lesson that have not gone out yet"""
+    try:
+        cancelled = get_outbox().cancel(lesson_id, kind='available')
+    except Exception as e:
+        log_notification(f"Could not cancel announcements for lesson {lesson_id}: {str(e)}")
+        return 0
+    if cancelled:
+        log_notification(f"Cancelled {cancelled} pending announcements for lesson {lesson_id}")
+    return cancelled
+
+def created_before_outbox(lesson_info, box):
+    """True if a lesson was created before the outbox started tracking who was announced to"""
+    created_at = pd.to_datetime(lesson_info.get('created_at'), errors='coerce')
+    if pd.isna(created_at):
+        return True
+    return created_at.to_pydatetime().timestamp() < box.created_at
+
+def announced_contacts(lesson_info, contacts, exclude=None):
+    """Return the eligible contacts who were actually sent the announcement for a lesson"""
+    eligible = contacts.eligible(lesson_info, exclude=exclude)
+    box = get_outbox()
+    if not sum(box.progress(lesson_info['id']).values()):
+        # Announced before the outbox tracked recipients: assume everyone eligible heard.
+        # A newer lesson without jobs was never announced, so nobody needs the filled notice.
+        return eligible if created_before_outbox(lesson_info, box) else []
+    notified = box.notified(lesson_info['id'], kind='available')
+    return [c for c in eligible if repository.contact_key(c.get('contact_id')) in notified]
+
+def notify_available_slot(lesson_info):
+    """Announce a slot to the contacts whose preferences match it, in waves; returns (queued, waves)"""
+    return queue_announcement(lesson_info, get_contact_index().eligible(lesson_info))
+
+def build_lesson_filled_messages(lesson_info, selected_contact, remaining_contacts):
+    """Yield the confirmation for the new student and the 'filled' notices for everyone else"""
+    confirmed = templates.LESSON_CONFIRMED.for_lesson(lesson_info)
+    confirm_email, confirm_html, confirm_sms = confirmed.render(name=selected_contact.get('name', ''))
     if selected_contact.get('email'):
-        success, msg = send_email(selected_contact['email'], confirm_subject, confirm_email)
-        result_msg = f"✅ Confirmation email to {selected_contact['name']}: {msg}"
-        results.append(result_msg)
-        log_notification(result_msg)
+        yield {'channel': 'email', 'to': selected_contact['email'], 'subject': confirmed.subject,
+               'body': confirm_email, 'html': confirm_html,
+               'label': f"✅ Confirmation email to {selected_contact['name']}",
+               'lesson_id': lesson_info['id'], 'contact_id': selected_contact.get('contact_id'), 'kind': 'confirmed'}
     if selected_contact.get('phone'):
-        success, msg = send_sms(selected_contact['phone'], confirm_sms)
-        result_msg = f"✅ Confirmation SMS to {selected_contact['name']}: {msg}"
-        results.append(result_msg)
-        log_notification(result_msg)
+        yield {'channel': 'sms', 'to': selected_contact['phone'], 'subject': confirmed.subject,
+               'body': confirm_sms, 'label': f"✅ Confirmation SMS to {selected_contact['name']}",
+               'lesson_id': lesson_info['id'], 'contact_id': selected_contact.get('contact_id'), 'kind': 'confirmed'}
+    # The 'filled' notice has no recipient fields, so every contact gets the same rendering
+    filled = templates.LESSON_FILLED.for_lesson(lesson_info)
+    filled_email, filled_html, filled_sms = filled.render()
+    batch_size = EMAIL_CONFIG['bcc_batch_size']
+    bcc_group = []
     for contact in remaining_contacts:
-        if contact.get('email'):
-            success, msg = send_email(contact['email'], filled_subject, filled_email)
-            result_msg = f"❌ Filled notification email to {contact['name']}: {msg}"
-            results.append(result_msg)
-            log_notification(result_msg)
+        if contact.get('email') and batch_size > 1:
+            bcc_group.append(contact)
+            if len(bcc_group) == batch_size:
+                yield _bcc_message(lesson_info, bcc_group, filled, filled_email, filled_html)
+                bcc_group = []
+        elif contact.get('email'):
+            yield {'channel': 'email', 'to': contact['email'], 'subject': filled.subject,
+                   'body': filled_email, 'html': filled_html,
+                   'label': f"❌ Filled notification email to {contact['name']}",
+                   'lesson_id': lesson_info['id'], 'contact_id': contact.get('contact_id'), 'kind': 'filled'}
         if contact.get('phone'):
-            success, msg = send_sms(contact['phone'], filled_sms)
-            result_msg = f"❌ Filled notification SMS to {contact['name']}: {msg}"
-            results.append(result_msg)
-            log_notification(result_msg)
-    return results
+            yield {'channel': 'sms', 'to': contact['phone'], 'subject': filled.subject,
+                   'body': filled_sms, 'label': f"❌ Filled notification SMS to {contact['name']}",
+                   'lesson_id': lesson_info['id'], 'contact_id': contact.get('contact_id'), 'kind': 'filled'}
+    if bcc_group:
+        yield _bcc_message(lesson_info, bcc_group, filled, filled_email, filled_html)
+
+def _bcc_message(lesson_info, contacts, rendered, body, html):
+    """One email to a group of contacts, addressed to ourselves with the group in BCC"""
+    names = ', '.join(str(contact['name']) for contact in contacts)
+    return {'channel': 'email', 'to': EMAIL_CONFIG['email'], 'bcc': [contact['email'] for contact in contacts],
+            'contact_ids': [contact.get('contact_id') for contact in contacts],
+            'subject': rendered.subject, 'body': body, 'html': html,
+            'label': f"❌ Filled notification email to {len(contacts)} contacts ({names})",
+            'lesson_id': lesson_info['id'], 'kind': 'filled'}
+
+def notify_lesson_filled(lesson_info, selected_contact, remaining_contacts):
+    """Notify about lesson being filled"""
+    return send_notifications(build_lesson_filled_messages(lesson_info, selected_contact, remaining_contacts))
+
+@st.fragment(run_every=REFRESH_INTERVAL)
+def watch_for_changes():
+    """Rerun the app only when the shared lesson state moved past the rendered revision"""
+    if get_lesson_state().revision != st.session_state.get('lessons_version'):
+        st.rerun(scope="app")
 
 # --- Main App Function ---
 def main():
+    # Times each section of the page run; a no-op unless metrics are enabled
+    laps = metrics.laps('render')
     st.set_page_config(
         page_title="🤺 Fencing Lesson Manager",
         page_icon="🤺",
         layout="wide",
         initial_sidebar_state="expanded"
     )
-    if 'canceled_lessons' not in st.session_state:
-        st.session_state.canceled_lessons = load_lessons_from_csv()
-    if 'contacts_db' not in st.session_state:
-        st.session_state.contacts_db = []
     if 'notification_log' not in st.session_state:
         st.session_state.notification_log = []
+    # Every session reads the same shared snapshot; remember its revision for auto-refresh
+    try:
+        state = get_lesson_state()
+        state.refresh()
+        lessons = state.snapshot()
+    except Exception as e:
+        st.error(f"Error loading lessons: {str(e)}")
+        lessons = lesson_state.LessonSnapshot(0)
+    st.session_state.lessons_version = lessons.revision
+    # Sessions only hold a reference; a re-import swaps in a new roster for everyone
+    roster = get_contact_index()
+    laps.lap('setup')
 
     st.title("🤺 Fencing Lesson Manager")
     st.markdown("### Manage canceled lessons and fill slots automatically")
@@ -291,21 +776,42 @@ def main():
         st.header("📋 Configuration")
         st.subheader("Upload Contacts")
         uploaded_file = st.file_uploader("Choose CSV file", type="csv")
+        # Each upload is imported once; reruns only redisplay its report
+        if uploaded_file is not None and st.session_state.get('contacts_upload_id') != uploaded_file.file_id:
+            success, result = import_contacts(uploaded_file)
+            st.session_state.contacts_upload_id = uploaded_file.file_id
+            # Keep only the report; the contacts themselves live in the shared roster
+            st.session_state.contacts_import = result if isinstance(result, str) else {
+                'saved': len(result.contacts) if success else 0,
+                'summary': result.summary(),
+                'issues': result.issues,
+                'issue_count': result.issue_count,
+                'preview': [dict(contact) for contact in result.contacts[:5]]
+            }
+            roster = get_contact_index()
         if uploaded_file is not None:
-            try:
-                df = pd.read_csv(uploaded_file)
-                st.session_state.contacts_db = df.to_dict('records')
-                st.success(f"✅ Loaded {len(st.session_state.contacts_db)} contacts")
-                st.subheader("Contacts Preview")
-                st.dataframe(df.head(), use_container_width=True)
-            except Exception as e:
-                st.error(f"Error loading CSV: {str(e)}")
+            report = st.session_state.contacts_import
+            if isinstance(report, str):
+                st.error(report)
+            else:
+                if report['saved']:
+                    st.success(f"✅ Saved {report['saved']} contacts to the roster")
+                else:
+                    st.error("No row in this file passed validation, so the existing roster was kept.")
+                st.caption(report['summary'])
+                if report['issues']:
+                    with st.expander(f"⚠️ {report['issue_count']} rows need attention"):
+                        st.dataframe(pd.DataFrame(report['issues']), use_container_width=True, hide_index=True)
+                        if report['issue_count'] > len(report['issues']):
+                            st.caption(f"Showing the first {len(report['issues'])} issues.")
+                if report['preview']:
+                    st.subheader("Contacts Preview")
+                    st.dataframe(pd.DataFrame(report['preview']), use_container_width=True)
         st.subheader("System Status")
         email_configured = bool(EMAIL_CONFIG['email'] and EMAIL_CONFIG['password'])
-        sms_configured = bool(TWILIO_CONFIG['account_sid'] and TWILIO_CONFIG['auth_token'])
         st.write(f"📧 Email: {'✅ Configured' if email_configured else '❌ Not configured'}")
-        st.write(f"📱 SMS: {'✅ Configured' if sms_configured else '❌ Not configured'}")
-        st.write(f"👥 Contacts: {len(st.session_state.contacts_db)} loaded")
+        st.write(f"📱 SMS: {'✅ Configured' if sms_configured() else '❌ Not configured'}")
+        st.write(f"👥 Contacts: {len(roster)} loaded")
         st.subheader("📊 CSV Log Statistics")
         csv_stats = get_csv_stats()
         st.write(f"📝 Total Cancellations: {csv_stats['total_cancellations']}")
@@ -313,28 +819,55 @@ def main():
         st.write(f"📈 Fill Rate: {csv_stats['fill_rate']}%")
         st.write(f"🕐 Recent Activity (7 days): {csv_stats['recent_activity']}")
 
-        if os.path.isfile("canceled_lessons_log.csv"):
-            with open("canceled_lessons_log.csv", "r") as f:
-                st.download_button(
-                    label="📥 Download Lessons Log",
-                    data=f.read(),
-                    file_name="fencing_lessons_log.csv",
-                    mime="text/csv"
-                )
+        if STORAGE_CONFIG['backend'] != 'csv' or os.path.isfile(LESSONS_CSV):
+            st.download_button(
+                label="📥 Download Lessons Log",
+                data=lessons_export,
+                file_name="fencing_lessons_log.csv",
+                mime="text/csv"
+            )
 
         st.subheader("🛠️ Developer Tools")
-        if st.button("Reload Lessons from CSV"):
-            st.session_state.canceled_lessons = load_lessons_from_csv()
-            st.success("Lessons reloaded from file!")
+        if st.button("Reload Lessons from Storage"):
+            get_lesson_state().refresh()
             st.rerun()
+        if st.button("Verify Log Statistics"):
+            if get_store().verify_stats():
+                st.success("Running statistics match a full recompute.")
+            else:
+                st.warning("Running statistics were out of date and have been rebuilt.")
+
+        if metrics.enabled():
+            st.subheader("⏱️ Performance Metrics")
+            timers, counters = metrics.snapshot()
+            if timers:
+                st.dataframe(pd.DataFrame(timers), use_container_width=True, hide_index=True)
+            for name, value in counters.items():
+                st.write(f"{name}: {value}")
+            if email_configured:
+                st.write(f"SMTP pool: {get_smtp_pool().stats}")
+            for channel in ('email', 'sms'):
+                limiter = get_rate_limiter(channel)
+                if limiter.max_rate:
+                    st.write(f"{channel} rate: {limiter.rate:.1f} of {limiter.max_rate:g}/s, {limiter.stats}")
+            st.download_button(
+                label="📥 Download Metrics",
+                data=metrics.prometheus_text(),
+                file_name="metrics.prom",
+                mime="text/plain"
+            )
+            if st.button("Reset Metrics"):
+                metrics.reset()
+                st.rerun()
+    laps.lap('sidebar')
 
     col1, col2, col3 = st.columns([1, 1, 1])
     with col1:
-        st.metric("Available Lessons", len([l for l in st.session_state.canceled_lessons if l['status'] == 'available']))
+        st.metric("Available Lessons", len(lessons.available))
     with col2:
-        st.metric("Filled Lessons", len([l for l in st.session_state.canceled_lessons if l['status'] == 'filled']))
+        st.metric("Filled Lessons", lessons.filled_total)
     with col3:
-        st.metric("Total Contacts", len(st.session_state.contacts_db))
+        st.metric("Total Contacts", len(roster))
 
     st.header("📅 Select Week")
     col1, col2 = st.columns([1, 2])
@@ -354,9 +887,16 @@ def main():
                 if st.button(f"{day['day']}\n{day['display'].split(', ')[1]}", key=f"day_{i}"):
                     selected_date = day['date']
                     st.session_state.selected_date = selected_date
+    laps.lap('week')
 
     st.header("❌ Add Canceled Lesson")
-    with st.form("add_cancellation_form"):
+    # Each rendering of the form gets its own key, replaced once a cancellation is added, so a
+    # second submit of the same form (a double click, a resent request) is recognised and ignored
+    if 'cancellation_form_id' not in st.session_state:
+        st.session_state.cancellation_form_id = uuid.uuid4().hex
+    form_id = st.session_state.cancellation_form_id
+    added_cancellations = st.session_state.setdefault('added_cancellations', {})
+    with st.form(f"add_cancellation_form_{form_id}"):
         col1, col2, col3, col4 = st.columns(4)
         with col1:
             lesson_date = st.selectbox(
@@ -372,9 +912,12 @@ def main():
             original_student = st.text_input("Original Student Name")
         submitted = st.form_submit_button("➕ Add Cancellation & Notify Contacts")
         if submitted:
-            if lesson_date and lesson_time and coach_name and original_student:
+            if form_id in added_cancellations:
+                st.info(f"This cancellation was already added as lesson {added_cancellations[form_id]}.")
+            elif lesson_date and lesson_time and coach_name and original_student:
+                # The store assigns a unique, never reused id when the lesson is saved
                 cancellation = {
-                    'id': len(st.session_state.canceled_lessons) + 1,
+                    'id': None,
                     'date': lesson_date,
                     'time': lesson_time,
                     'coach': coach_name,
@@ -382,31 +925,39 @@ def main():
                     'status': 'available',
                     'created_at': datetime.now().strftime('%Y-%m-%d %H:%M')
                 }
-                st.session_state.canceled_lessons.append(cancellation)
-                csv_success, csv_msg = save_lessons_to_csv(st.session_state.canceled_lessons)
-                if csv_success:
-                    log_notification(f"Cancellation logged to CSV: {csv_msg}")
+                csv_success, csv_msg = record_lesson_created(cancellation)
+                if not csv_success:
+                    # Without a stored lesson there is no id for claim links, so nobody is notified
+                    st.error(f"Cancellation not saved and no notifications sent: {csv_msg}")
                 else:
-                    st.warning(f"Logging failed: {csv_msg}")
-                if st.session_state.contacts_db:
-                    with st.spinner("Sending notifications..."):
-                        results = notify_available_slot(cancellation)
-                    st.success(f"✅ Cancellation added and {len(results)} notifications sent!")
-                    with st.expander("View notification results"):
-                        for result in results:
-                            st.write(f"• {result}")
-                        if csv_success:
-                            st.write(f"• CSV: {csv_msg}")
-                else:
-                    st.warning("⚠️ Cancellation added but no contacts loaded for notifications")
-                st.rerun()
+                    added_cancellations[form_id] = cancellation['id']
+                    st.session_state.cancellation_form_id = uuid.uuid4().hex
+                    log_notification(f"Cancellation logged to CSV: {csv_msg}")
+                    if len(roster):
+                        # Only members whose coach, weekday and time preferences match are notified;
+                        # delivery happens in the background and progress shows in the notification log
+                        audience = roster.eligible(cancellation)
+                        queued, waves = queue_announcement(cancellation, audience)
+                        st.success(
+                            f"✅ Cancellation added and {queued} notifications queued for "
+                            f"{len(audience)} of {len(roster)} contacts in {waves} waves!"
+                        )
+                    else:
+                        st.warning("⚠️ Cancellation added but no contacts loaded for notifications")
+                    st.rerun()
             else:
                 st.error("Please fill in all fields")
+    laps.lap('form')
 
     st.header("📋 Available Lessons")
-    available_lessons = [l for l in st.session_state.canceled_lessons if l['status'] == 'available']
+    available_lessons = lessons.available
     if available_lessons:
-        for lesson in available_lessons:
+        # The rest are in the Full Lessons Log below, filtered by status
+        if len(available_lessons) > UPCOMING_AVAILABLE_LIMIT:
+            st.caption(f"Showing the {UPCOMING_AVAILABLE_LIMIT} soonest of {len(available_lessons)} available lessons.")
+        upcoming = heapq.nsmallest(UPCOMING_AVAILABLE_LIMIT, available_lessons,
+                                   key=lambda l: (str(l['date']), str(l['time'])))
+        for lesson in upcoming:
             with st.expander(f"🕐 {lesson['date']} at {lesson['time']} with {lesson['coach']} (was {lesson['original_student']})"):
                 st.write(f"**Coach:** {lesson['coach']}")
                 st.write(f"**Original Student:** {lesson['original_student']}")
@@ -415,36 +966,48 @@ def main():
     else:
         st.info("No available lessons at the moment")
 
-    filled_lessons = [l for l in st.session_state.canceled_lessons if l['status'] == 'filled']
+    filled_lessons = lessons.filled
     if filled_lessons:
         st.header("✅ Filled Lessons")
+        # Older fills are in the paginated Full Lessons Log below
+        if lessons.filled_total > len(filled_lessons):
+            st.caption(f"Showing the {len(filled_lessons)} most recent of {lessons.filled_total} filled lessons.")
         for lesson in filled_lessons:
             with st.expander(f"✅ {lesson['date']} at {lesson['time']} with {lesson['coach']} - Filled by {lesson['filled_by']}"):
                 st.write(f"**Coach:** {lesson['coach']}")
                 st.write(f"**Original Student:** {lesson['original_student']}")
                 st.write(f"**Filled By:** {lesson['filled_by']}")
                 st.write(f"**Filled At:** {lesson['filled_at']}")
+    laps.lap('lessons')
 
-    # --- View the full lesson log in the UI ---
-    st.header("📖 Full Lessons Log")
-    log_data = load_lessons_from_csv()
-    if log_data:
-        df_log = pd.DataFrame(log_data)
-        st.dataframe(df_log, use_container_width=True)
-    else:
-        st.info("The lessons log is currently empty.")
+    # --- View the full lesson log in the UI, one page at a time ---
+    lessons_log_section()
+    laps.lap('log')
 
-    if st.session_state.notification_log:
+    notification_outbox = get_outbox()
+    outbox_progress = notification_outbox.progress()
+    if st.session_state.notification_log or any(outbox_progress.values()):
         st.header("📧 Notification Log")
+        in_flight = outbox_progress['pending'] + outbox_progress['sending']
+        st.write(
+            f"📤 Outbox: {in_flight} pending, {outbox_progress['sent']} sent, {outbox_progress['failed']} failed, "
+            f"{outbox_progress['cancelled']} cancelled"
+        )
         with st.expander("View notification history"):
+            for job in notification_outbox.recent(20):
+                timestamp = datetime.fromtimestamp(job['updated_at']).strftime('%Y-%m-%d %H:%M:%S')
+                st.code(f"[{timestamp}] {job['label']}: {job['result'] or job['status']}", language=None)
             for log_entry in reversed(st.session_state.notification_log[-20:]):
                 st.code(log_entry, language=None)
 
     st.sidebar.header("🔄 Auto-refresh")
-    auto_refresh = st.sidebar.checkbox("Enable auto-refresh (30 seconds)")
+    auto_refresh = st.sidebar.checkbox(f"Enable auto-refresh ({REFRESH_INTERVAL} seconds)")
     if auto_refresh:
-        time.sleep(30)
-        st.rerun()
+        # Runs on a timer without holding the script thread; reruns only on changes
+        watch_for_changes()
+    laps.lap('notifications')
+    if metrics.enabled() and METRICS_CONFIG['path']:
+        metrics.write_prometheus(METRICS_CONFIG['path'])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""Process-wide SMS client with connection reuse and batch sending.
+
+A single client per account is shared by every session and worker thread.
+The Twilio transport keeps one pooled HTTP session alive between messages;
+the fake transport lets the notification path be load-tested offline.
+
+Sends go through a rate limiter. A send that is throttled by the provider
+(HTTP 429), or that cannot get a send slot in time, returns ``(None, msg)``
+instead of ``(False, msg)``, so callers can reschedule it instead of
+counting it as a failure.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+import metrics
+import rate_limit
+
+
+def is_throttled(error):
+    """True if a provider error means 'too many requests'"""
+    return getattr(error, 'status', None) == 429
+
+
+class FakeThrottle(RuntimeError):
+    status = 429
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TwilioTransport:
+    """Sends messages through the Twilio REST API over a keep-alive HTTP pool.
+
+    Twilio's exceptions do not carry the response headers, so a response
+    hook keeps each thread's last Retry-After and a 429 is given it as
+    ``retry_after``.
+    """
+
+    def __init__(self, account_sid, auth_token, pool_size=8, timeout=30):
+        http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+        http_client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        http_client.session.hooks['response'].append(self._remember_retry_after)
+        self._client = Client(account_sid, auth_token, http_client=http_client)
+        self._last = threading.local()
+
+    def _remember_retry_after(self, response, *args, **kwargs):
+        self._last.retry_after = response.headers.get('Retry-After')
+
+    def create(self, to, from_, body):
+        self._last.retry_after = None
+        try:
+            return self._client.messages.create(body=body, from_=from_, to=to)
+        except Exception as e:
+            if is_throttled(e):
+                e.retry_after = rate_limit.parse_retry_after(self._last.retry_after)
+            raise
+
+
+class FakeTransport:
+    """In-memory stand-in for Twilio that records messages instead of sending them.
+
+    ``latency`` simulates the provider round trip in seconds,
+    ``failure_rate`` makes that fraction of sends raise an error, and
+    ``rate_limit`` rejects sends beyond that many per second with a 429.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, rate_limit=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.sent = []
+        self.throttled = 0
+        self._window = (0, 0)  # (second, sends in it)
+        self._lock = threading.Lock()
+
+    def create(self, to, from_, body):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("Simulated provider failure")
+        with self._lock:
+            if self.rate_limit:
+                second = int(time.monotonic())
+                count = self._window[1] + 1 if self._window[0] == second else 1
+                if count > self.rate_limit:
+                    self.throttled += 1
+                    raise FakeThrottle("Too Many Requests", retry_after=second + 1 - time.monotonic())
+                self._window = (second, count)
+            self.sent.append({'to': to, 'from': from_, 'body': body})
+            return len(self.sent)
+
+
+class SMSClient:
+    """Thread-safe SMS sender with a bounded pool for batch sends"""
+
+    def __init__(self, transport, from_number, max_workers=8, limiter=rate_limit.UNLIMITED, max_wait=None):
+        self.transport = transport
+        self.from_number = from_number
+        self.limiter = limiter
+        self.max_wait = max_wait
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sms-client")
+
+    @metrics.timed('sms_send')
+    def send(self, to_phone, body):
+        """Send one SMS and return (success, message); success is None if it should be retried later"""
+        try:
+            self.limiter.acquire(self.max_wait)
+        except rate_limit.RateLimited as e:
+            return None, f"SMS deferred: {str(e)}"
+        try:
+            self.transport.create(to=to_phone, from_=self.from_number, body=body)
+        except Exception as e:
+            if is_throttled(e):
+                self.limiter.throttled(retry_after=getattr(e, 'retry_after', None))
+                return None, f"SMS throttled by provider: {str(e)}"
+            metrics.count('sms_errors')
+            return False, f"SMS error: {str(e)}"
+        self.limiter.succeeded()
+        return True, "SMS sent successfully"
+
+    def send_batch(self, messages):
+        """Send (phone, body) pairs concurrently and return their results in order"""
+        futures = [self._executor.submit(self.send, phone, body) for phone, body in messages]
+        return [f.result() for f in futures]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(account_sid, auth_token, from_number, transport='twilio', max_workers=8, fake_latency=0.0,
+               fake_rate_limit=0, limiter=rate_limit.UNLIMITED, max_wait=None):
+    """Return the process-wide SMS client for an account, creating it on first use"""
+    key = (account_sid, auth_token, from_number, transport)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if transport == 'fake':
+                backend = FakeTransport(latency=fake_latency, rate_limit=fake_rate_limit)
+            else:
+                backend = TwilioTransport(account_sid, auth_token, pool_size=max_workers)
+            client = _clients[key] = SMSClient(backend, from_number, max_workers=max_workers,
+                                               limiter=limiter, max_wait=max_wait)
+        return client
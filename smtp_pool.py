@@ -0,0 +1,238 @@
+"""Pooled SMTP sessions shared across messages and Streamlit reruns.
+
+Streamlit re-executes the page script on every interaction, but imported
+modules stay loaded, so pools kept here live for the whole server process.
+"""
+import atexit
+import logging
+import re
+import smtplib
+import threading
+import time
+
+import metrics
+import rate_limit
+
+# Errors that mean the connection itself is gone and a fresh one may succeed
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+# Replies providers use for "slow down" / "try again later"
+THROTTLE_CODES = {421, 450, 451}
+
+# SMTP has no Retry-After header, but some providers put a wait in the reply text,
+# e.g. "421 4.7.0 Try again in 60 seconds"
+_RETRY_IN = re.compile(r'\b(?:in|after)\s+(\d+)\s*(s|secs?|seconds?|m|mins?|minutes?)\b', re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttled(error):
+    """True if an SMTP error is the server asking us to slow down"""
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code in THROTTLE_CODES
+
+
+def retry_after(error):
+    """Seconds to wait named in a throttling reply, or None if the reply gives none"""
+    text = error.smtp_error
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    match = _RETRY_IN.search(str(text))
+    if match is None:
+        return None
+    return float(match.group(1)) * (60 if match.group(2).lower().startswith('m') else 1)
+
+
+def _quit(server):
+    """Close a connection, ignoring errors from an already dead socket"""
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+class SMTPPool:
+    """A bounded pool of logged-in SMTP connections.
+
+    At most ``max_size`` connections exist at once. Idle connections are
+    reused until they have been unused for ``idle_timeout`` seconds, when a
+    background timer closes them, and a reused connection that turns out to
+    be dead is replaced transparently.
+    Every message first takes a slot from ``limiter``, waiting at most
+    ``max_wait`` seconds; throttling replies slow the limiter down.
+    """
+
+    def __init__(self, host, port, username, password, max_size=4, idle_timeout=60,
+                 starttls=True, timeout=30, connect=smtplib.SMTP, limiter=rate_limit.UNLIMITED, max_wait=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.starttls = starttls
+        self.timeout = timeout
+        self._connect = connect
+        self.limiter = limiter
+        self.max_wait = max_wait
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []  # (server, last_used) pairs, most recently used last
+        self._evictor = None  # timer that closes idle connections once they time out
+        self.stats = {'connects': 0, 'reuses': 0, 'reconnects': 0, 'evictions': 0}
+
+    @metrics.timed('smtp_connect')
+    def _open(self):
+        server = self._connect(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            _quit(server)
+            raise
+        with self._lock:
+            self.stats['connects'] += 1
+        return server
+
+    def _take_stale(self, now):
+        """Remove idle connections past their timeout; caller holds the lock"""
+        fresh = [(s, t) for s, t in self._idle if now - t < self.idle_timeout]
+        stale = [s for s, t in self._idle if now - t >= self.idle_timeout]
+        self._idle = fresh
+        self.stats['evictions'] += len(stale)
+        return stale
+
+    def _checkout(self):
+        """Return (server, reused) using an idle connection when one is available"""
+        with self._lock:
+            stale = self._take_stale(time.monotonic())
+            server = self._idle.pop()[0] if self._idle else None
+            if server is not None:
+                self.stats['reuses'] += 1
+        for old in stale:
+            _quit(old)
+        if server is not None:
+            return server, True
+        return self._open(), False
+
+    def _release(self, server):
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+            self._schedule_eviction()
+
+    def _schedule_eviction(self):
+        """Arm the timer for when the oldest idle connection times out; caller holds the lock"""
+        if self._evictor is not None or not self._idle:
+            return
+        delay = max(0.0, self._idle[0][1] + self.idle_timeout - time.monotonic())
+        self._evictor = threading.Timer(delay, self.evict_idle)
+        self._evictor.daemon = True
+        self._evictor.start()
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        """Send ``msg`` over a pooled connection, reconnecting once if it was dropped.
+
+        Returns the recipients the server refused, as ``smtplib`` does. Raises
+        rate_limit.RateLimited if no send slot came free within ``max_wait``.
+        """
+        self.limiter.acquire(self.max_wait)
+        with self._slots:
+            try:
+                server, reused = self._checkout()
+            except smtplib.SMTPResponseException as e:
+                # Providers also refuse new sessions with 421 when we connect too often
+                if is_throttled(e):
+                    self.limiter.throttled(retry_after=retry_after(e))
+                raise
+            try:
+                refused = server.send_message(msg, from_addr, to_addrs)
+            except RECONNECT_ERRORS:
+                _quit(server)
+                if not reused:
+                    raise
+                with self._lock:
+                    self.stats['reconnects'] += 1
+                server = self._open()
+                try:
+                    refused = server.send_message(msg, from_addr, to_addrs)
+                except Exception:
+                    _quit(server)
+                    raise
+            except smtplib.SMTPResponseException as e:
+                if is_throttled(e):
+                    self.limiter.throttled(retry_after=retry_after(e))
+                # 421 means the server is closing this session
+                if e.smtp_code == 421:
+                    _quit(server)
+                else:
+                    self._release(server)
+                raise
+            except smtplib.SMTPRecipientsRefused:
+                # smtplib resets the session, so the connection is still usable
+                self._release(server)
+                raise
+            except Exception:
+                _quit(server)
+                raise
+            self._release(server)
+            self.limiter.succeeded()
+            return refused
+
+    def evict_idle(self):
+        """Close connections that have been idle longer than ``idle_timeout``"""
+        with self._lock:
+            stale = self._take_stale(time.monotonic())
+            if self._evictor is threading.current_thread():
+                self._evictor = None
+            self._schedule_eviction()
+        for server in stale:
+            _quit(server)
+        return len(stale)
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            if self._evictor is not None:
+                self._evictor.cancel()
+                self._evictor = None
+        for server, _ in idle:
+            _quit(server)
+
+
+_pools = {}  # account -> (pool, options it was built with)
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, username, password, **options):
+    """Return the process-wide pool for an SMTP account, creating it on first use.
+
+    If the options differ from the ones the pool was built with, e.g. after
+    a settings change, the old pool is closed and replaced.
+    """
+    key = (host, int(port), username, password)
+    with _pools_lock:
+        pool, built_with = _pools.get(key, (None, None))
+        old = None
+        if pool is not None and built_with != options:
+            logger.info("SMTP pool settings for %s:%s changed, replacing the pool", host, port)
+            old, pool = pool, None
+        if pool is None:
+            pool = SMTPPool(host, int(port), username, password, **options)
+            _pools[key] = (pool, options)
+    if old is not None:
+        # Connections still in use go back to the old pool and are closed when they time out
+        old.close()
+    return pool
+
+
+@atexit.register
+def close_all():
+    """Close idle connections in every pool"""
+    with _pools_lock:
+        pools = [pool for pool, _ in _pools.values()]
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,90 @@
+"""Running lesson statistics for the sidebar.
+
+Counters are updated as cancellations are added and lessons are filled, so
+reading them does not touch the lesson history. ``rebuild`` recomputes
+everything from a full lesson list and is only needed after the store was
+changed by someone else, or to verify the running totals.
+"""
+from bisect import insort
+from collections import deque
+from datetime import datetime, timedelta
+import threading
+
+import pandas as pd
+
+
+def _created_at(lesson):
+    created_at = pd.to_datetime(lesson.get('created_at'), errors='coerce')
+    if pd.isna(created_at):
+        return None
+    return created_at.to_pydatetime()
+
+
+class LessonStats:
+    """Cancellation and fill counters with a sliding window of recent cancellations"""
+
+    def __init__(self, window_days=7):
+        self.window = timedelta(days=window_days)
+        self.total_cancellations = 0
+        self.total_filled = 0
+        self._recent = deque()  # creation times inside the window, oldest first
+        self._lock = threading.Lock()
+
+    def _add_recent(self, created_at, now):
+        if created_at is None or created_at < now - self.window:
+            return
+        if not self._recent or created_at >= self._recent[-1]:
+            self._recent.append(created_at)
+        else:
+            insort(self._recent, created_at)
+
+    def _trim(self, now):
+        cutoff = now - self.window
+        while self._recent and self._recent[0] < cutoff:
+            self._recent.popleft()
+
+    def rebuild(self, lessons):
+        """Recompute every counter from the full list of lessons"""
+        lessons = list(lessons)
+        cutoff = datetime.now() - self.window
+        recent = sorted(t for t in map(_created_at, lessons) if t is not None and t >= cutoff)
+        with self._lock:
+            self.total_cancellations = len(lessons)
+            self.total_filled = len([l for l in lessons if l['status'] == 'filled'])
+            self._recent = deque(recent)
+
+    def lesson_created(self, lesson):
+        """Count a newly added cancellation"""
+        with self._lock:
+            self.total_cancellations += 1
+            if lesson.get('status') == 'filled':
+                self.total_filled += 1
+            self._add_recent(_created_at(lesson), datetime.now())
+
+    def lesson_filled(self, lesson):
+        """Count an available lesson that has just been filled"""
+        with self._lock:
+            self.total_filled += 1
+
+    def snapshot(self, now=None):
+        """Return the statistics in the sidebar's format"""
+        now = now or datetime.now()
+        with self._lock:
+            self._trim(now)
+            stats = {
+                'total_cancellations': self.total_cancellations,
+                'total_filled': self.total_filled,
+                'fill_rate': 0.0,
+                'recent_activity': len(self._recent)
+            }
+        if stats['total_cancellations'] > 0:
+            stats['fill_rate'] = round((stats['total_filled'] / stats['total_cancellations']) * 100, 2)
+        return stats
+
+    def verify(self, lessons, now=None):
+        """Return True if the running counters match a full recompute of ``lessons``"""
+        now = now or datetime.now()
+        fresh = LessonStats()
+        fresh.window = self.window
+        fresh.rebuild(lessons)
+        return fresh.snapshot(now) == self.snapshot(now)
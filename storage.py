@@ -0,0 +1,976 @@
+"""Lesson and contact persistence behind a small pluggable store interface.
+
+``CSVStore`` keeps the original file layout: a CSV snapshot of lessons plus
+an append-only event log, and contacts in ``contacts.csv``. Creating or
+filling a lesson appends one line to the event log instead of rewriting the
+whole CSV. Every ``compact_every`` events the log is folded into a fresh
+snapshot, which is written to a temporary file and renamed into place so a
+crash never leaves a half-written CSV behind.
+
+``SQLiteStore`` keeps the same data in an indexed SQLite file so lookups by
+status, date, coach or contact do not parse the whole history. Run
+``python storage.py import-csv`` to migrate existing CSV files into it.
+
+``MemoryStore`` keeps everything in the current process and persists
+nothing; it is the stand-in backend for tests and benchmarks.
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+
+import pandas as pd
+
+import metrics
+from repository import CONTACT_FIELDS, ContactIndex, LessonIndex
+from stats import LessonStats
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LESSON_COLUMNS = [
+    'lesson_id', 'date entered', 'lesson date', 'time', 'coach', 'fencer',
+    'status', 'filled by', 'filled at'
+]
+
+
+def lesson_to_row(lesson):
+    """Convert an app lesson dict to a CSV row dict"""
+    return {
+        'lesson_id': lesson['id'],
+        'date entered': lesson['created_at'],
+        'lesson date': lesson['date'],
+        'time': lesson['time'],
+        'coach': lesson['coach'],
+        'fencer': lesson['original_student'],
+        'status': lesson['status'],
+        'filled by': lesson.get('filled_by', ''),
+        'filled at': lesson.get('filled_at', ''),
+    }
+
+
+def lesson_filter(start_date=None, end_date=None, coach=None):
+    """Return a predicate for lessons within an inclusive date range and with a coach"""
+    def keep(lesson):
+        date = str(lesson['date'])[:10]
+        return ((start_date is None or date >= start_date)
+                and (end_date is None or date <= end_date)
+                and (coach is None or lesson['coach'] == coach))
+    return keep
+
+
+def csv_chunks(lessons, chunk_size=1000):
+    """Yield lessons as CSV text in the snapshot format, ``chunk_size`` rows at a time"""
+    header = True
+    chunk = []
+    for lesson in lessons:
+        chunk.append(lesson_to_row(lesson))
+        if len(chunk) == chunk_size:
+            yield pd.DataFrame(chunk, columns=LESSON_COLUMNS).to_csv(index=False, header=header)
+            header = False
+            chunk = []
+    if chunk or header:
+        yield pd.DataFrame(chunk, columns=LESSON_COLUMNS).to_csv(index=False, header=header)
+
+
+def row_to_lesson(lesson):
+    """Rename CSV row keys in place to the app's internal lesson format"""
+    lesson['id'] = lesson.pop('lesson_id')
+    lesson['date'] = lesson.pop('lesson date')
+    lesson['original_student'] = lesson.pop('fencer')
+    lesson['created_at'] = lesson.pop('date entered')
+    lesson['filled_by'] = lesson.get('filled by', '')
+    lesson['filled_at'] = lesson.get('filled at', '')
+    return lesson
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _file_signature(*paths):
+    """Identify the current contents of files by inode, mtime and size"""
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+        else:
+            signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+class LessonLog:
+    """Lessons stored as a CSV snapshot followed by a JSON-lines event log.
+
+    Every parse and write holds an exclusive lock on a sidecar ``.lock`` file,
+    so several server processes can share the same files safely. Parsed
+    lessons are cached until the files' inode, mtime or size change; our own
+    writes update the cache in place instead of forcing a re-parse.
+    """
+
+    def __init__(self, snapshot_path, events_path=None, compact_every=500):
+        self.snapshot_path = snapshot_path
+        self.events_path = events_path or os.path.splitext(snapshot_path)[0] + '.events.jsonl'
+        self.lock_path = os.path.splitext(snapshot_path)[0] + '.lock'
+        self.sequence_path = os.path.splitext(snapshot_path)[0] + '.seq'
+        self.identity_path = os.path.splitext(snapshot_path)[0] + '.id'
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+        self._pending_events = 0
+        self._cache = None  # LessonIndex of the parsed lessons
+        self._cache_signature = None
+        self.stats = LessonStats()
+
+    @contextmanager
+    def locked(self):
+        """Hold the in-process and cross-process lock; re-entrant within a thread"""
+        with self._lock:
+            if self._lock_depth == 0:
+                self._lock_file = open(self.lock_path, 'a+')
+                _lock_file(self._lock_file)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    _unlock_file(self._lock_file)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def _signature(self):
+        return _file_signature(self.snapshot_path, self.events_path)
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return []
+        try:
+            df = pd.read_csv(self.snapshot_path)
+        except pd.errors.EmptyDataError:
+            return []
+        # Handle datetime conversion to avoid future errors
+        df['date entered'] = pd.to_datetime(df['date entered'])
+        return [row_to_lesson(lesson) for lesson in df.to_dict('records')]
+
+    def _read_events(self):
+        if not os.path.exists(self.events_path):
+            return []
+        events = []
+        with open(self.events_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # A torn final line from a crash mid-append is skipped
+                    continue
+        return events
+
+    @staticmethod
+    def _apply(lessons, event):
+        """Apply one event to a LessonIndex.
+
+        Returns ('created', lesson) or ('filled', lesson) when the event added a
+        lesson or filled an available one, and None otherwise.
+        """
+        if event['event'] == 'created':
+            lesson = dict(event['lesson'])
+            lesson['created_at'] = pd.to_datetime(lesson['created_at'])
+            return ('created', lesson) if lessons.add(lesson) else None
+        if event['event'] == 'filled' and event['id'] in lessons:
+            newly_filled = lessons.get(event['id'])['status'] != 'filled'
+            lesson = lessons.update(
+                event['id'], status='filled', filled_by=event['filled_by'], filled_at=event['filled_at']
+            )
+            return ('filled', lesson) if newly_filled else None
+        return None
+
+    def _lessons(self):
+        """Return the cached LessonIndex, re-parsing if the files changed; caller holds the lock"""
+        signature = self._signature()
+        if self._cache is None or signature != self._cache_signature:
+            with metrics.timer('lesson_log_parse'):
+                lessons = LessonIndex(self._read_snapshot())
+                events = self._read_events()
+                for event in events:
+                    self._apply(lessons, event)
+            self._cache = lessons
+            self._cache_signature = signature
+            self._pending_events = len(events)
+            self.stats.rebuild(lessons.values())
+        return self._cache
+
+    def _read(self, read):
+        """Return ``read(index)`` on current lessons, skipping the file lock if nothing changed"""
+        with self._lock:
+            if self._cache is not None and self._signature() == self._cache_signature:
+                return read(self._cache)
+        with self.locked():
+            return read(self._lessons())
+
+    def load(self):
+        """Return copies of all lessons: the snapshot with the event log replayed on top"""
+        return self._read(lambda lessons: [dict(lesson) for lesson in lessons.values()])
+
+    def lesson_stats(self):
+        """Return the running statistics, recomputing only if the files changed elsewhere"""
+        return self._read(lambda lessons: self.stats.snapshot())
+
+    def get(self, lesson_id):
+        """Return a copy of one lesson, or None"""
+        def read(lessons):
+            lesson = lessons.get(lesson_id)
+            return dict(lesson) if lesson is not None else None
+        return self._read(read)
+
+    def with_status(self, status):
+        """Return copies of the lessons with a status"""
+        return self._read(lambda lessons: [dict(lesson) for lesson in lessons.with_status(status)])
+
+    def append(self, event):
+        """Durably append one event, compacting the log when it grows too long"""
+        line = json.dumps(event, default=str) + '\n'
+        with self.locked():
+            # Bring the cache up to date first so other processes' events are not lost
+            lessons = self._lessons()
+            with open(self.events_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            change = self._apply(lessons, json.loads(line))
+            if change is not None:
+                kind, lesson = change
+                if kind == 'created':
+                    self.stats.lesson_created(lesson)
+                else:
+                    self.stats.lesson_filled(lesson)
+            self._cache_signature = self._signature()
+            self._pending_events += 1
+            if self._pending_events >= self.compact_every:
+                self.compact()
+
+    def _read_sequence(self):
+        try:
+            with open(self.sequence_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def identity(self):
+        """Return the random id of this log, created on first use.
+
+        Lesson ids only identify a lesson within one log, so records kept
+        elsewhere about a lesson (such as the delivery ledger) pair its id
+        with this one. Removing the log's files starts a new identity.
+        """
+        with self.locked():
+            try:
+                with open(self.identity_path, 'r') as f:
+                    identity = f.read().strip()
+            except FileNotFoundError:
+                identity = ''
+            if not identity:
+                identity = uuid.uuid4().hex
+                _atomic_write(self.identity_path, lambda f: f.write(identity))
+            return identity
+
+    def _next_id(self):
+        """Issue the next lesson id; caller holds the lock.
+
+        The last issued id is persisted next to the log, so ids of removed
+        lessons are never handed out again and old claim links stay invalid.
+        """
+        next_id = max(self._read_sequence(), self._lessons().max_id) + 1
+        _atomic_write(self.sequence_path, lambda f: f.write(str(next_id)))
+        return next_id
+
+    def record_created(self, lesson):
+        """Append a 'lesson created' event, assigning the next id if the lesson has none"""
+        fields = ['id', 'date', 'time', 'coach', 'original_student', 'status', 'created_at']
+        with self.locked():
+            if lesson.get('id') is None:
+                lesson['id'] = self._next_id()
+            self.append({'event': 'created', 'lesson': {key: lesson.get(key) for key in fields}})
+        return lesson['id']
+
+    def record_filled(self, lesson):
+        """Append a 'lesson filled' event"""
+        self.append({
+            'event': 'filled',
+            'id': lesson['id'],
+            'filled_by': lesson['filled_by'],
+            'filled_at': lesson['filled_at'],
+        })
+
+    def _write_snapshot(self, lessons):
+        df = pd.DataFrame([lesson_to_row(lesson) for lesson in lessons], columns=LESSON_COLUMNS)
+        _atomic_write(self.snapshot_path, lambda f: df.to_csv(f, index=False))
+        # Events are only dropped once the snapshot containing them is in place
+        open(self.events_path, 'w').close()
+        self._pending_events = 0
+
+    def write_snapshot(self, lessons):
+        """Atomically replace the snapshot with ``lessons`` and clear the event log"""
+        with self.locked():
+            self._write_snapshot(lessons)
+            self._cache = None
+
+    def compact(self):
+        """Fold the event log into a new snapshot"""
+        with self.locked():
+            self._write_snapshot(list(self._lessons().values()))
+            self._cache_signature = self._signature()
+
+    def claim(self, lesson_id, filled_by, filled_at):
+        """Mark a lesson filled only if it is still available; returns the lesson or None"""
+        with self.locked():
+            lesson = self._lessons().get(lesson_id)
+            if lesson is None or lesson['status'] != 'available':
+                return None
+            self.record_filled({'id': lesson['id'], 'filled_by': filled_by, 'filled_at': filled_at})
+            return dict(lesson)
+
+
+class CSVStore:
+    """Store backed by the lessons CSV, its event log and contacts.csv"""
+
+    backend = 'csv'
+
+    def __init__(self, lessons_csv, contacts_csv, compact_every=500):
+        self.lessons_csv = lessons_csv
+        self.contacts_csv = contacts_csv
+        self.log = LessonLog(lessons_csv, compact_every=compact_every)
+        self.store_id = self.log.identity()
+        self._contacts_lock = threading.Lock()
+        self._contacts = None
+        self._contacts_signature = None
+
+    def load_lessons(self):
+        return self.log.load()
+
+    def save_lessons(self, lessons):
+        self.log.write_snapshot(lessons)
+
+    def add_lesson(self, lesson):
+        """Store a new lesson, assigning it a fresh id if it has none; returns the id"""
+        return self.log.record_created(lesson)
+
+    def claim_lesson(self, lesson_id, filled_by, filled_at):
+        return self.log.claim(lesson_id, filled_by, filled_at)
+
+    def get_lesson(self, lesson_id):
+        return self.log.get(lesson_id)
+
+    def available_lessons(self, start_date=None, end_date=None):
+        """Return available lessons, optionally within an inclusive date range"""
+        return [
+            lesson for lesson in self.log.with_status('available')
+            if (start_date is None or str(lesson['date']) >= start_date)
+            and (end_date is None or str(lesson['date']) <= end_date)
+        ]
+
+    def version(self):
+        """Return a cheap token that changes whenever the stored lessons change"""
+        return self.log._signature()
+
+    def lesson_stats(self):
+        return self.log.lesson_stats()
+
+    def verify_stats(self):
+        """Compare the running statistics with a full recompute, rebuilding them on mismatch"""
+        lessons = self.load_lessons()
+        if self.log.stats.verify(lessons):
+            return True
+        self.log.stats.rebuild(lessons)
+        return False
+
+    def _select(self, start_date=None, end_date=None, coach=None, status=None):
+        """Return the cached lessons matching the filters, in log order; callers must not modify them"""
+        keep = lesson_filter(start_date, end_date, coach)
+        return self.log._read(
+            lambda lessons: [l for l in (lessons.with_status(status) if status else lessons.values()) if keep(l)]
+        )
+
+    def lesson_page(self, start_date=None, end_date=None, coach=None, status=None, offset=0, limit=50):
+        """Return (lessons, total): one page of matching lessons, latest lesson date first"""
+        # The cache keeps lessons sorted by date, so a page never scans the history
+        page, total = self.log._read(
+            lambda lessons: lessons.page(start_date, end_date, coach, status, offset, limit)
+        )
+        return [dict(lesson) for lesson in page], total
+
+    def iter_export_csv(self, chunk_size=1000, **filters):
+        """Yield the matching lessons as CSV text in chunks, in log order"""
+        return csv_chunks(self._select(**filters), chunk_size)
+
+    def coaches(self):
+        """Return the coaches that appear in the lesson log"""
+        return self.log._read(lambda lessons: lessons.coaches())
+
+    def contact_index(self):
+        """Return the ContactIndex for contacts.csv, re-reading it only when it changed"""
+        with self._contacts_lock:
+            signature = _file_signature(self.contacts_csv)
+            if self._contacts is None or signature != self._contacts_signature:
+                contacts = []
+                if os.path.exists(self.contacts_csv):
+                    try:
+                        # Read as text so phone numbers keep their '+' and ids their leading zeros
+                        contacts = pd.read_csv(self.contacts_csv, dtype=str, keep_default_na=False,
+                                               encoding='utf-8-sig').to_dict('records')
+                    except pd.errors.EmptyDataError:
+                        pass
+                self._contacts = ContactIndex(contacts)
+                self._contacts_signature = signature
+            return self._contacts
+
+    def load_contacts(self):
+        return [dict(contact) for contact in self.contact_index()]
+
+    def save_contacts(self, contacts):
+        """Write the roster and swap it in as the shared ContactIndex in one step"""
+        roster = ContactIndex(contacts)
+        df = pd.DataFrame([[contact[field] for field in CONTACT_COLUMNS] for contact in roster],
+                          columns=CONTACT_COLUMNS)
+        with self._contacts_lock:
+            _atomic_write(self.contacts_csv, lambda f: df.to_csv(f, index=False))
+            # Sessions still holding the old roster keep a consistent copy until they ask again
+            self._contacts = roster
+            self._contacts_signature = _file_signature(self.contacts_csv)
+
+
+def _atomic_write(path, write):
+    """Write a file through ``write(f)`` into a temp file and rename it into place"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix=os.path.splitext(path)[1], dir=directory)
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lessons (
+    lesson_id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    lesson_date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    coach TEXT NOT NULL,
+    fencer TEXT NOT NULL,
+    status TEXT NOT NULL,
+    filled_by TEXT,
+    filled_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_lessons_status_date ON lessons (status, lesson_date, time);
+CREATE INDEX IF NOT EXISTS idx_lessons_date ON lessons (lesson_date);
+CREATE INDEX IF NOT EXISTS idx_lessons_coach_date ON lessons (coach, lesson_date);
+CREATE TABLE IF NOT EXISTS contacts (
+    contact_id TEXT NOT NULL,
+    name TEXT,
+    email TEXT,
+    phone TEXT,
+    coaches TEXT,
+    weekdays TEXT,
+    time_from TEXT,
+    time_to TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_contacts_contact_id ON contacts (contact_id);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+CONTACT_COLUMNS = CONTACT_FIELDS
+
+LESSON_SELECT = (
+    "SELECT lesson_id, created_at, lesson_date, time, coach, fencer, status, filled_by, filled_at FROM lessons"
+)
+
+
+def _sql_value(value):
+    """Convert pandas/numpy values to something sqlite3 accepts, mapping NaN to NULL"""
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value) if not isinstance(value, (int, float, str)) else value
+
+
+def _parse_timestamp(value):
+    """Parse a stored creation time, taking the fast path for ISO strings"""
+    try:
+        return pd.Timestamp(datetime.fromisoformat(value))
+    except (TypeError, ValueError):
+        return pd.to_datetime(value)
+
+
+class SQLiteStore:
+    """Store backed by an indexed SQLite database file"""
+
+    backend = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._cache_lock = threading.Lock()
+        self._cache = {}  # query name -> (file signature, result)
+        self._write_lock = threading.Lock()
+        self.stats = LessonStats()
+        self._stats_signature = None
+        conn = self._connect()
+        try:
+            conn.executescript(SQLITE_SCHEMA)
+            # Databases created before contact preferences existed lack their columns
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(contacts)")}
+            for column in CONTACT_COLUMNS:
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE contacts ADD COLUMN {column} TEXT")
+            # A random id for this database, so a recreated file is told apart from the old one
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO store_meta (key, value) VALUES ('store_id', ?)", (uuid.uuid4().hex,))
+            self.store_id = conn.execute("SELECT value FROM store_meta WHERE key = 'store_id'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _signature(self):
+        return _file_signature(self.path, self.path + '-wal')
+
+    def _cached(self, name, load):
+        """Return ``load()`` from the cache while the database file is unchanged"""
+        signature = self._signature()
+        with self._cache_lock:
+            entry = self._cache.get(name)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+        rows = load()
+        with self._cache_lock:
+            self._cache[name] = (signature, rows)
+        return rows
+
+    def _invalidate(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @metrics.timed('sqlite_query')
+    def _query(self, sql, params=()):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    @metrics.timed('sqlite_write')
+    def _execute(self, sql, rows, many=False):
+        conn = self._connect()
+        try:
+            with conn:
+                cursor = conn.executemany(sql, rows) if many else conn.execute(sql, rows)
+            return cursor.rowcount
+        finally:
+            conn.close()
+            self._invalidate()
+
+    @staticmethod
+    def _lesson(row):
+        lesson_id, created_at, lesson_date, time, coach, fencer, status, filled_by, filled_at = row
+        return {
+            'id': lesson_id,
+            'date': lesson_date,
+            'time': time,
+            'coach': coach,
+            'original_student': fencer,
+            'status': status,
+            'created_at': _parse_timestamp(created_at),
+            'filled_by': filled_by or '',
+            'filled_at': filled_at or '',
+        }
+
+    @staticmethod
+    def _lesson_params(lesson):
+        row = lesson_to_row(lesson)
+        return tuple(_sql_value(row[column]) for column in LESSON_COLUMNS)
+
+    def load_lessons(self):
+        lessons = self._cached(
+            'lessons', lambda: [self._lesson(row) for row in self._query(LESSON_SELECT + " ORDER BY lesson_id")]
+        )
+        return [dict(lesson) for lesson in lessons]
+
+    def save_lessons(self, lessons):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM lessons")
+                conn.executemany(
+                    "INSERT INTO lessons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self._lesson_params(lesson) for lesson in lessons]
+                )
+        finally:
+            conn.close()
+            self._invalidate()
+
+    def _track(self, write, update):
+        """Run a write and apply ``update`` to the running stats if they were current"""
+        with self._write_lock:
+            in_sync = self._stats_signature == self._signature()
+            result = write()
+            if in_sync:
+                update(result)
+                self._stats_signature = self._signature()
+        return result
+
+    def version(self):
+        """Return a cheap token that changes whenever the database changes"""
+        return self._signature()
+
+    def lesson_stats(self):
+        """Return the running statistics, rebuilding them if the database changed elsewhere"""
+        with self._write_lock:
+            signature = self._signature()
+            if self._stats_signature != signature:
+                self.stats.rebuild(self.load_lessons())
+                self._stats_signature = signature
+            return self.stats.snapshot()
+
+    def verify_stats(self):
+        """Compare the running statistics with a full recompute, rebuilding them on mismatch"""
+        self.lesson_stats()
+        lessons = self.load_lessons()
+        if self.stats.verify(lessons):
+            return True
+        self.stats.rebuild(lessons)
+        return False
+
+    def _insert_lesson(self, lesson):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # Take the write lock before reading the sequence so concurrent writers serialise
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if lesson.get('id') is None:
+                    row = conn.execute("SELECT value FROM sequences WHERE name = 'lesson_id'").fetchone()
+                    max_id = conn.execute("SELECT COALESCE(MAX(lesson_id), 0) FROM lessons").fetchone()[0]
+                    lesson['id'] = max(row[0] if row else 0, max_id) + 1
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sequences (name, value) VALUES ('lesson_id', ?)", (lesson['id'],)
+                    )
+                conn.execute("INSERT INTO lessons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._lesson_params(lesson))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+            self._invalidate()
+        return lesson['id']
+
+    def add_lesson(self, lesson):
+        """Store a new lesson, assigning it a fresh id if it has none; returns the id"""
+        return self._track(
+            lambda: self._insert_lesson(lesson),
+            lambda lesson_id: self.stats.lesson_created(lesson)
+        )
+
+    def claim_lesson(self, lesson_id, filled_by, filled_at):
+        """Mark a lesson filled only if it is still available; returns the lesson or None"""
+        def update(lesson):
+            if lesson is not None:
+                self.stats.lesson_filled(lesson)
+        return self._track(lambda: self._claim(lesson_id, filled_by, filled_at), update)
+
+    def _claim(self, lesson_id, filled_by, filled_at):
+        conn = self._connect()
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "UPDATE lessons SET status = 'filled', filled_by = ?, filled_at = ? "
+                    "WHERE lesson_id = ? AND status = 'available'",
+                    (filled_by, filled_at, lesson_id)
+                )
+                if cursor.rowcount != 1:
+                    return None
+                row = conn.execute(LESSON_SELECT + " WHERE lesson_id = ?", (lesson_id,)).fetchone()
+            return self._lesson(row)
+        finally:
+            conn.close()
+            self._invalidate()
+
+    def get_lesson(self, lesson_id):
+        row = self._query(LESSON_SELECT + " WHERE lesson_id = ?", (lesson_id,))
+        return self._lesson(row[0]) if row else None
+
+    def available_lessons(self, start_date=None, end_date=None):
+        """Return available lessons, optionally within an inclusive date range"""
+        sql = LESSON_SELECT + " WHERE status = 'available'"
+        params = []
+        if start_date is not None:
+            sql += " AND lesson_date >= ?"
+            params.append(start_date)
+        if end_date is not None:
+            sql += " AND lesson_date <= ?"
+            params.append(end_date)
+        return [self._lesson(row) for row in self._query(sql + " ORDER BY lesson_date, time", params)]
+
+    @staticmethod
+    def _where(start_date=None, end_date=None, coach=None, status=None):
+        clauses, params = [], []
+        for clause, value in (("lesson_date >= ?", start_date), ("lesson_date <= ?", end_date),
+                              ("coach = ?", coach), ("status = ?", status)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def lesson_page(self, start_date=None, end_date=None, coach=None, status=None, offset=0, limit=50):
+        """Return (lessons, total): one page of matching lessons, latest lesson date first"""
+        where, params = self._where(start_date, end_date, coach, status)
+        total = self._query("SELECT COUNT(*) FROM lessons" + where, params)[0][0]
+        rows = self._query(
+            LESSON_SELECT + where + " ORDER BY lesson_date DESC, time DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        )
+        return [self._lesson(row) for row in rows], total
+
+    def iter_export_csv(self, chunk_size=1000, **filters):
+        """Yield the matching lessons as CSV text in chunks, reading the database incrementally"""
+        where, params = self._where(**filters)
+        conn = self._connect()
+        try:
+            cursor = conn.execute(LESSON_SELECT + where + " ORDER BY lesson_id", params)
+
+            def lessons():
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        return
+                    yield from (self._lesson(row) for row in rows)
+
+            yield from csv_chunks(lessons(), chunk_size)
+        finally:
+            conn.close()
+
+    def coaches(self):
+        """Return the coaches that appear in the lesson log"""
+        return [coach for coach, in self._query("SELECT DISTINCT coach FROM lessons ORDER BY coach")]
+
+    def contact_index(self):
+        """Return a ContactIndex of all contacts, cached while the database is unchanged"""
+        return self._cached('contacts', lambda: ContactIndex(
+            dict(zip(CONTACT_COLUMNS, row))
+            for row in self._query(f"SELECT {', '.join(CONTACT_COLUMNS)} FROM contacts ORDER BY rowid")
+        ))
+
+    def load_contacts(self):
+        return [dict(contact) for contact in self.contact_index()]
+
+    def save_contacts(self, contacts):
+        """Replace the contacts and swap in the new roster as the cached ContactIndex"""
+        roster = ContactIndex(contacts)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM contacts")
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO contacts ({', '.join(CONTACT_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(CONTACT_COLUMNS))})",
+                    [tuple(_sql_value(c.get(key)) for key in CONTACT_COLUMNS) for c in roster]
+                )
+        finally:
+            conn.close()
+            self._invalidate()
+        with self._cache_lock:
+            self._cache['contacts'] = (self._signature(), roster)
+
+
+class MemoryStore:
+    """Store kept entirely in this process's memory.
+
+    A stand-in for tests, benchmarks and demos: it behaves like the other
+    stores, but nothing is persisted and other processes cannot see it.
+    """
+
+    backend = 'memory'
+
+    def __init__(self, lessons=(), contacts=()):
+        self._lock = threading.RLock()
+        self._lessons = LessonIndex(dict(lesson) for lesson in lessons)
+        self._contacts = ContactIndex(contacts)
+        self._next_id = self._lessons.max_id
+        self._version = 0
+        self.store_id = uuid.uuid4().hex  # ids restart with every new store
+        self.stats = LessonStats()
+        self.stats.rebuild(self._lessons.values())
+
+    def _changed(self):
+        self._version += 1
+
+    def load_lessons(self):
+        with self._lock:
+            return [dict(lesson) for lesson in self._lessons.values()]
+
+    def save_lessons(self, lessons):
+        with self._lock:
+            self._lessons = LessonIndex(dict(lesson) for lesson in lessons)
+            self._next_id = max(self._next_id, self._lessons.max_id)
+            self.stats.rebuild(self._lessons.values())
+            self._changed()
+
+    def add_lesson(self, lesson):
+        """Store a new lesson, assigning it a fresh id if it has none; returns the id"""
+        with self._lock:
+            if lesson.get('id') is None:
+                self._next_id = max(self._next_id, self._lessons.max_id) + 1
+                lesson['id'] = self._next_id
+            stored = dict(lesson)
+            if self._lessons.add(stored):
+                self.stats.lesson_created(stored)
+                self._changed()
+            return lesson['id']
+
+    def claim_lesson(self, lesson_id, filled_by, filled_at):
+        with self._lock:
+            lesson = self._lessons.get(lesson_id)
+            if lesson is None or lesson['status'] != 'available':
+                return None
+            lesson = self._lessons.update(lesson_id, status='filled', filled_by=filled_by, filled_at=filled_at)
+            self.stats.lesson_filled(lesson)
+            self._changed()
+            return dict(lesson)
+
+    def get_lesson(self, lesson_id):
+        with self._lock:
+            lesson = self._lessons.get(lesson_id)
+            return dict(lesson) if lesson is not None else None
+
+    def available_lessons(self, start_date=None, end_date=None):
+        """Return available lessons, optionally within an inclusive date range"""
+        return [dict(lesson) for lesson in self._select(start_date, end_date, status='available')]
+
+    def version(self):
+        return self._version
+
+    def lesson_stats(self):
+        with self._lock:
+            return self.stats.snapshot()
+
+    def verify_stats(self):
+        lessons = self.load_lessons()
+        if self.stats.verify(lessons):
+            return True
+        self.stats.rebuild(lessons)
+        return False
+
+    def _select(self, start_date=None, end_date=None, coach=None, status=None):
+        keep = lesson_filter(start_date, end_date, coach)
+        with self._lock:
+            lessons = self._lessons.with_status(status) if status else list(self._lessons.values())
+            return [lesson for lesson in lessons if keep(lesson)]
+
+    def lesson_page(self, start_date=None, end_date=None, coach=None, status=None, offset=0, limit=50):
+        """Return (lessons, total): one page of matching lessons, latest lesson date first"""
+        with self._lock:
+            page, total = self._lessons.page(start_date, end_date, coach, status, offset, limit)
+            return [dict(lesson) for lesson in page], total
+
+    def iter_export_csv(self, chunk_size=1000, **filters):
+        return csv_chunks([dict(lesson) for lesson in self._select(**filters)], chunk_size)
+
+    def coaches(self):
+        with self._lock:
+            return self._lessons.coaches()
+
+    def contact_index(self):
+        return self._contacts
+
+    def load_contacts(self):
+        return [dict(contact) for contact in self._contacts]
+
+    def save_contacts(self, contacts):
+        self._contacts = ContactIndex(contacts)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(backend='csv', lessons_csv='canceled_lessons_log.csv', contacts_csv='contacts.csv',
+              sqlite_path='lessons.db', compact_every=500):
+    """Return the process-wide store for the configured backend"""
+    key = (backend, sqlite_path) if backend == 'sqlite' else (backend, lessons_csv, contacts_csv)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            if backend == 'sqlite':
+                store = SQLiteStore(sqlite_path)
+            elif backend == 'memory':
+                store = MemoryStore()
+            else:
+                store = CSVStore(lessons_csv, contacts_csv, compact_every=compact_every)
+            _stores[key] = store
+        return store
+
+
+def import_csvs(sqlite_path, lessons_csv='canceled_lessons_log.csv', contacts_csv='contacts.csv'):
+    """Copy lessons and contacts from the CSV files into a SQLite store"""
+    source = CSVStore(lessons_csv, contacts_csv)
+    target = SQLiteStore(sqlite_path)
+    lessons = source.load_lessons()
+    contacts = source.load_contacts()
+    target.save_lessons(lessons)
+    target.save_contacts(contacts)
+    return len(lessons), len(contacts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lesson manager storage tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('import-csv', help="migrate the CSV files into a SQLite database")
+    migrate.add_argument('--db', default='lessons.db', help="SQLite database to create or replace")
+    migrate.add_argument('--lessons', default='canceled_lessons_log.csv')
+    migrate.add_argument('--contacts', default='contacts.csv')
+    args = parser.parse_args(argv)
+    if args.command == 'import-csv':
+        lessons, contacts = import_csvs(args.db, args.lessons, args.contacts)
+        print(f"Imported {lessons} lessons and {contacts} contacts into {args.db}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Notification templates compiled once and rendered in two stages.
+
+Templates use ``{field}`` for lesson fields and ``$field`` for recipient
+fields (``$name``, ``$fill_link``). ``for_lesson`` fills in the lesson once
+per announcement and returns a ``LessonMessage``. Its ``render`` only
+substitutes the recipient fields, in one pass over the pre-rendered text per
+recipient, so the lesson fields are never formatted or escaped again.
+"""
+from html import escape
+from string import Template
+
+
+def _fields(lesson, html):
+    # '$' is the recipient placeholder marker, so lesson values must not introduce one
+    values = {}
+    for key, value in lesson.items():
+        value = '' if value is None else str(value)
+        if html:
+            value = escape(value)
+        values[key] = value.replace('$', '$$')
+    return values
+
+
+class NotificationTemplate:
+    """Subject, plain-text, HTML and SMS variants of one kind of notification"""
+
+    def __init__(self, subject, text, html=None, sms=None):
+        self.subject = subject
+        self.text = text
+        self.html = html
+        self.sms = sms
+
+    def for_lesson(self, lesson):
+        """Render the lesson-specific parts once and return a LessonMessage"""
+        text_fields = _fields(lesson, html=False)
+        html_fields = _fields(lesson, html=True) if self.html else None
+        return LessonMessage(
+            Template(self.subject.format(**text_fields)).safe_substitute(),
+            Template(self.text.format(**text_fields)),
+            Template(self.html.format(**html_fields)) if self.html else None,
+            Template(self.sms.format(**text_fields)) if self.sms else None
+        )
+
+
+class LessonMessage:
+    """A template with the lesson filled in, waiting for recipient fields"""
+
+    def __init__(self, subject, text, html, sms):
+        self.subject = subject
+        self._text = text
+        self._html = html
+        self._sms = sms
+
+    def render(self, **recipient):
+        """Return the (text, html, sms) bodies for one recipient; missing variants are None"""
+        html_recipient = {key: escape(str(value)) for key, value in recipient.items()}
+        return (
+            self._text.substitute(recipient),
+            self._html.substitute(html_recipient) if self._html else None,
+            self._sms.substitute(recipient) if self._sms else None
+        )
+
+
+AVAILABLE_SLOT = NotificationTemplate(
+    subject="🤺 Fencing Lesson Available with {coach} - {date} at {time}",
+    text="""
+A fencing lesson slot has become available!
+
+📅 **Date:** {date}
+⏰ **Time:** {time} (25 minutes)
+👨‍🏫 **Coach:** {coach}
+👤 **Originally Scheduled For:** {original_student}
+
+To claim this lesson, simply click the link below:
+$fill_link
+
+This slot is available on a first-come, first-served basis.
+
+Best regards,
+Your Fencing Coach
+        """,
+    html="""<p>Hi $name,</p>
+<p>A fencing lesson slot has become available!</p>
+<ul>
+<li>📅 <b>Date:</b> {date}</li>
+<li>⏰ <b>Time:</b> {time} (25 minutes)</li>
+<li>👨‍🏫 <b>Coach:</b> {coach}</li>
+<li>👤 <b>Originally Scheduled For:</b> {original_student}</li>
+</ul>
+<p><a href="$fill_link">Claim this lesson</a></p>
+<p>This slot is available on a first-come, first-served basis.</p>
+<p>Best regards,<br>Your Fencing Coach</p>
+""",
+    sms="🤺 Fencing lesson with {coach} is available on {date} at {time}. Claim it now: $fill_link"
+)
+
+LESSON_CONFIRMED = NotificationTemplate(
+    subject="✅ Fencing Lesson Confirmed with {coach} - {date} at {time}",
+    text="""
+Congratulations! Your fencing lesson has been confirmed:
+📅 **Date:** {date}
+⏰ **Time:** {time} (25 minutes)
+👨‍🏫 **Coach:** {coach}
+Please arrive 5 minutes early. See you there!
+Best regards,
+Your Fencing Coach
+    """,
+    html="""<p>Congratulations $name! Your fencing lesson has been confirmed:</p>
+<ul>
+<li>📅 <b>Date:</b> {date}</li>
+<li>⏰ <b>Time:</b> {time} (25 minutes)</li>
+<li>👨‍🏫 <b>Coach:</b> {coach}</li>
+</ul>
+<p>Please arrive 5 minutes early. See you there!</p>
+<p>Best regards,<br>Your Fencing Coach</p>
+""",
+    sms="✅ Fencing lesson confirmed with {coach} for {date} at {time}. Arrive 5 min early!"
+)
+
+LESSON_FILLED = NotificationTemplate(
+    subject="❌ Fencing Lesson Filled with {coach} - {date} at {time}",
+    text="""
+The fencing lesson slot with {coach} for {date} at {time} has been filled by another student.
+Thank you for your interest! We'll notify you of future available slots.
+Best regards,
+Your Fencing Coach
+    """,
+    html="""<p>The fencing lesson slot with {coach} for {date} at {time} has been filled by another student.</p>
+<p>Thank you for your interest! We'll notify you of future available slots.</p>
+<p>Best regards,<br>Your Fencing Coach</p>
+""",
+    sms="❌ Fencing lesson with {coach} on {date} at {time} has been filled. Thanks for your interest!"
+)
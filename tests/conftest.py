@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# The app modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+def open_store(backend, directory):
+    """Open the store of a backend over files in ``directory``, as each worker process does"""
+    if backend == 'memory':
+        return storage.MemoryStore()
+    if backend == 'sqlite':
+        return storage.SQLiteStore(os.path.join(directory, 'lessons.db'))
+    return storage.CSVStore(os.path.join(directory, 'canceled_lessons_log.csv'),
+                            os.path.join(directory, 'contacts.csv'))
+
+
+def make_lesson(lesson_id=None, **fields):
+    lesson = {
+        'id': lesson_id,
+        'date': '2026-11-02',
+        'time': '18:00',
+        'coach': 'Julian',
+        'original_student': 'Stu',
+        'status': 'available',
+        'created_at': '2026-10-30 09:15',
+        'filled_by': '',
+        'filled_at': ''
+    }
+    lesson.update(fields)
+    return lesson
+
+
+@pytest.fixture(params=['csv', 'sqlite'])
+def backend(request):
+    return request.param
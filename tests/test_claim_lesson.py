@@ -0,0 +1,49 @@
+"""Several processes race to claim the same lessons; each lesson must have exactly one winner."""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import random
+
+import pytest
+
+from conftest import make_lesson, open_store
+
+WORKERS = 8
+LESSONS = 40
+
+
+def _claim_all(backend, directory, worker, start):
+    store = open_store(backend, directory)
+    lesson_ids = list(range(1, LESSONS + 1))
+    random.Random(worker).shuffle(lesson_ids)
+    start.wait()
+    return [lesson_id for lesson_id in lesson_ids
+            if store.claim_lesson(lesson_id, f"Worker {worker}", '2026-10-31 12:00') is not None]
+
+
+def test_each_lesson_has_one_winner(backend, tmp_path):
+    store = open_store(backend, str(tmp_path))
+    store.save_lessons([make_lesson(i) for i in range(1, LESSONS + 1)])
+
+    with multiprocessing.Manager() as manager:
+        start = manager.Barrier(WORKERS)
+        with ProcessPoolExecutor(WORKERS) as pool:
+            futures = [pool.submit(_claim_all, backend, str(tmp_path), worker, start) for worker in range(WORKERS)]
+            wins = {worker: future.result() for worker, future in enumerate(futures)}
+
+    claimed = [lesson_id for won in wins.values() for lesson_id in won]
+    assert sorted(claimed) == list(range(1, LESSONS + 1))
+    stored = {lesson['id']: lesson for lesson in open_store(backend, str(tmp_path)).load_lessons()}
+    for worker, won in wins.items():
+        for lesson_id in won:
+            assert stored[lesson_id]['status'] == 'filled'
+            assert stored[lesson_id]['filled_by'] == f"Worker {worker}"
+
+
+@pytest.mark.parametrize('backend', ['csv', 'sqlite', 'memory'])
+def test_claim_returns_the_filled_lesson(backend, tmp_path):
+    store = open_store(backend, str(tmp_path))
+    store.save_lessons([make_lesson(1)])
+    lesson = store.claim_lesson(1, 'Ana', '2026-10-31 12:00')
+    assert lesson['status'] == 'filled'
+    assert lesson['filled_by'] == 'Ana'
+    assert store.claim_lesson(1, 'Ben', '2026-10-31 12:01') is None
@@ -0,0 +1,24 @@
+"""The delivery ledger is shared by every server process through one SQLite file."""
+from conftest import open_store
+
+import ledger
+
+
+def test_release_in_another_process_is_seen(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    # Two ledgers over one file stand in for two server processes
+    first, second = ledger.DeliveryLedger(path), ledger.DeliveryLedger(path)
+    key = ledger.delivery_key('store', 1, 7, 'sms', 'available')
+
+    assert first.reserve([key]) == [key]
+    assert second.reserve([key]) == []
+    first.release([key])
+    assert second.reserve([key]) == [key]
+
+
+def test_new_store_does_not_inherit_deliveries(tmp_path):
+    delivery_ledger = ledger.DeliveryLedger(str(tmp_path / 'ledger.db'))
+    for store in (open_store('memory', str(tmp_path)), open_store('memory', str(tmp_path))):
+        # Both stores number their first lesson 1
+        key = ledger.delivery_key(store.store_id, 1, 7, 'sms', 'available')
+        assert delivery_ledger.reserve([key]) == [key]
@@ -0,0 +1,52 @@
+"""Several processes create cancellations at once; every lesson must get its own id."""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from conftest import make_lesson, open_store
+
+WORKERS = 8
+PER_WORKER = 25
+
+
+def _create_lessons(backend, directory, worker, start):
+    store = open_store(backend, directory)
+    start.wait()
+    return [store.add_lesson(make_lesson(original_student=f"Worker {worker} #{i}")) for i in range(PER_WORKER)]
+
+
+def test_parallel_creates_get_unique_ids(backend, tmp_path):
+    store = open_store(backend, str(tmp_path))
+    store.save_lessons([make_lesson(i) for i in range(1, 6)])
+
+    with multiprocessing.Manager() as manager:
+        start = manager.Barrier(WORKERS)
+        with ProcessPoolExecutor(WORKERS) as pool:
+            futures = [pool.submit(_create_lessons, backend, str(tmp_path), worker, start)
+                       for worker in range(WORKERS)]
+            ids = [lesson_id for future in futures for lesson_id in future.result()]
+
+    assert len(ids) == len(set(ids)) == WORKERS * PER_WORKER
+    assert not set(ids) & set(range(1, 6))
+    stored = open_store(backend, str(tmp_path)).load_lessons()
+    assert len(stored) == 5 + WORKERS * PER_WORKER
+    assert sorted(lesson['id'] for lesson in stored) == sorted(list(range(1, 6)) + ids)
+    by_id = {lesson['id']: lesson for lesson in stored}
+    for worker, future in enumerate(futures):
+        for i, lesson_id in enumerate(future.result()):
+            assert by_id[lesson_id]['original_student'] == f"Worker {worker} #{i}"
+
+
+def test_ids_are_not_reused(backend, tmp_path):
+    store = open_store(backend, str(tmp_path))
+    first = store.add_lesson(make_lesson())
+    store.save_lessons([])
+    assert store.add_lesson(make_lesson()) > first
+
+
+def test_store_id_changes_when_ids_can_restart(backend, tmp_path):
+    (tmp_path / 'first').mkdir()
+    (tmp_path / 'second').mkdir()
+    first = open_store(backend, str(tmp_path / 'first'))
+    assert open_store(backend, str(tmp_path / 'first')).store_id == first.store_id
+    # A new set of files hands out lesson ids from 1 again
+    assert open_store(backend, str(tmp_path / 'second')).store_id != first.store_id
@@ -0,0 +1,14 @@
+from conftest import make_lesson, open_store
+import lesson_state
+
+
+def test_snapshot_uses_indexed_queries(backend, tmp_path, monkeypatch):
+    store = open_store(backend, str(tmp_path))
+    store.save_lessons([make_lesson(i, date=f"2026-11-{i:02d}") for i in range(1, 6)] +
+                       [make_lesson(i, date=f"2026-10-{i - 5:02d}", status='filled', filled_by='Ana')
+                        for i in range(6, 10)])
+    monkeypatch.setattr(store, 'load_lessons', lambda: (_ for _ in ()).throw(AssertionError("full load")))
+    snapshot = lesson_state.LessonState(store, recent_filled=3).snapshot()
+    assert [l['id'] for l in snapshot.available] == [1, 2, 3, 4, 5]
+    assert [l['id'] for l in snapshot.filled] == [9, 8, 7]
+    assert snapshot.filled_total == 4
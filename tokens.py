@@ -0,0 +1,56 @@
+"""Signed, stateless claim tokens for Fill_Lesson links.
+
+A token carries the lesson id, the contact id and an expiry time, signed with
+HMAC-SHA256 under a server-side secret. The Fill page can reject forged,
+altered or expired links by checking the signature alone, before it reads
+any lessons or contacts.
+
+Token format: ``<payload>.<signature>``, both URL-safe base64 without
+padding, where the payload is ``<lesson_id>:<contact_id>:<expires_at>``.
+"""
+import base64
+import hashlib
+import hmac
+import time
+
+# 128 bits of the HMAC digest keeps links short while staying unguessable
+SIGNATURE_BYTES = 16
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(secret, payload):
+    return hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def sign(secret, lesson_id, contact_id, expires_at):
+    """Return a token for a contact's claim on a lesson, valid until ``expires_at`` (epoch seconds)"""
+    payload = f"{lesson_id}:{contact_id}:{int(expires_at)}".encode('utf-8')
+    return f"{_b64encode(payload)}.{_b64encode(_signature(secret, payload))}"
+
+
+def verify(secret, token, now=None):
+    """Check a token and return (True, (lesson_id, contact_id)) or (False, reason)"""
+    try:
+        encoded_payload, encoded_signature = token.split('.')
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except (AttributeError, ValueError):
+        return False, "malformed"
+    if not hmac.compare_digest(signature, _signature(secret, payload)):
+        return False, "bad signature"
+    try:
+        lesson_id, rest = payload.decode('utf-8').split(':', 1)
+        contact_id, expires_at = rest.rsplit(':', 1)
+        expires_at = int(expires_at)
+    except ValueError:
+        return False, "malformed"
+    if (now if now is not None else time.time()) >= expires_at:
+        return False, "expired"
+    return True, (lesson_id, contact_id)